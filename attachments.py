@@ -0,0 +1,145 @@
+import os, base64, hashlib, tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import inspect, text
+from gmail_service import get_gmail_service, execute
+from models import Attachment, Email
+
+# Content-addressed store: <root>/<sha[:2]>/<sha[2:4]>/<sha256>, so identical
+# attachments (newsletters, signatures, forwarded files) are written once.
+ATTACHMENTS_ROOT = os.getenv("ATTACHMENTS_DIR", "attachments")
+ATTACHMENT_WORKERS = int(os.getenv("ATTACHMENT_WORKERS", "4"))
+
+# PostgreSQL upgrade of the original attachments table, which kept file
+# contents inline and had no ON DELETE CASCADE on email_id.
+PG_UPGRADE_DDL = [
+    """
+    ALTER TABLE attachments
+        ADD COLUMN IF NOT EXISTS mime_type VARCHAR,
+        ADD COLUMN IF NOT EXISTS size INTEGER,
+        ADD COLUMN IF NOT EXISTS gmail_attachment_id VARCHAR,
+        ADD COLUMN IF NOT EXISTS sha256 VARCHAR(64)
+    """,
+    "ALTER TABLE attachments DROP CONSTRAINT IF EXISTS attachments_email_id_fkey",
+    """
+    ALTER TABLE attachments ADD CONSTRAINT attachments_email_id_fkey
+        FOREIGN KEY (email_id) REFERENCES emails (id) ON DELETE CASCADE
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_attachments_email_id ON attachments (email_id)",
+    "CREATE INDEX IF NOT EXISTS ix_attachments_sha256 ON attachments (sha256)",
+]
+
+
+def ensure_attachment_columns(engine):
+    """Bring an attachments table from before the content-addressed store up to date (idempotent)."""
+    if "sha256" in {c["name"] for c in inspect(engine).get_columns("attachments")}:
+        return
+    with engine.begin() as conn:
+        if engine.dialect.name != "sqlite":
+            for ddl in PG_UPGRADE_DDL:
+                conn.execute(text(ddl))
+            return
+        # SQLite cannot change a foreign key in place, so the table is rebuilt
+        for index in inspect(conn).get_indexes("attachments"):
+            conn.execute(text(f'DROP INDEX "{index["name"]}"'))
+        conn.execute(text("ALTER TABLE attachments RENAME TO attachments_old"))
+        Attachment.__table__.create(conn)
+        conn.execute(text(
+            "INSERT INTO attachments (id, email_id, filename, filepath) "
+            "SELECT id, email_id, filename, filepath FROM attachments_old"
+        ))
+        conn.execute(text("DROP TABLE attachments_old"))
+
+
+def discover_parts(payload):
+    """Yield every attachment part of a format="full" message payload."""
+    stack = [payload or {}]
+    while stack:
+        part = stack.pop()
+        stack.extend(reversed(part.get("parts", []) or []))
+        body = part.get("body", {}) or {}
+        if part.get("filename") and (body.get("attachmentId") or body.get("data")):
+            yield part
+
+
+def blob_path(sha256):
+    return os.path.join(ATTACHMENTS_ROOT, sha256[:2], sha256[2:4], sha256)
+
+
+def store_blob(data):
+    """Write data to the store unless an identical blob exists. Returns (sha256, path)."""
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = blob_path(sha256)
+    if not os.path.exists(path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".blob-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    return sha256, path
+
+
+def _download(creds, message_id, part):
+    # Runs in a worker thread, which has its own cached service.
+    body = part["body"]
+    data = body.get("data")
+    if not data:
+        response = execute(get_gmail_service(creds).users().messages().attachments().get(
+            userId="me", messageId=message_id, id=body["attachmentId"],
+        ))
+        data = response["data"]
+    sha256, path = store_blob(base64.urlsafe_b64decode(data))
+    return dict(
+        filename=part["filename"],
+        mime_type=part.get("mimeType"),
+        size=body.get("size"),
+        gmail_attachment_id=body.get("attachmentId"),
+        sha256=sha256,
+        filepath=path,
+    )
+
+
+def download_attachments(creds, messages, workers=ATTACHMENT_WORKERS):
+    """
+    Download the attachments of fetched messages ({message_id: format="full"
+    resource}) into the blob store in parallel. Runs before the caller opens
+    its write transaction, so no lock is held across the network. Returns
+    {message_id: [Attachment column dicts]}.
+    """
+    jobs = [(msg_id, part) for msg_id, msg in messages.items()
+            for part in discover_parts(msg.get("payload"))]
+    downloaded = defaultdict(list)
+    if not jobs:
+        return downloaded
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        stored = list(pool.map(lambda job: _download(creds, *job), jobs))
+    for (msg_id, _), row in zip(jobs, stored):
+        downloaded[msg_id].append(row)
+    return downloaded
+
+
+def store_attachments(db, account_id, downloaded):
+    """
+    Add the Attachment rows of freshly inserted messages, from
+    download_attachments ({message_id: [row dicts]}). The caller commits.
+    """
+    if not downloaded:
+        return 0
+
+    email_ids = dict(
+        db.query(Email.message_id, Email.id)
+        .filter(Email.account_id == account_id, Email.message_id.in_(list(downloaded)))
+        .all()
+    )
+    count = 0
+    for msg_id, rows in downloaded.items():
+        for row in rows:
+            db.add(Attachment(email_id=email_ids[msg_id], **row))
+            count += 1
+    return count
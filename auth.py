@@ -1,28 +1,161 @@
-import os
-from google_auth_oauthlib.flow import Flow
+import os, tempfile, threading, time
+from datetime import datetime, timedelta
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from fastapi import HTTPException
+from metrics import TOKEN_REFRESHES, TOKEN_REFRESH_SECONDS
+from logs import get_logger
+
+log = get_logger("auth")
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly",
           "https://www.googleapis.com/auth/gmail.send"]
 CLIENT_SECRETS_FILE = "credentials.json"
-TOKEN_FILE = "token.json"
-
-flow = Flow.from_client_secrets_file(
-    CLIENT_SECRETS_FILE,
-    scopes=SCOPES,
-    redirect_uri="http://localhost:8000/oauth2callback"
-)
-
-def get_credentials():
-    if os.path.exists(TOKEN_FILE):
-        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-        if creds and creds.valid:
-            return creds
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-            with open(TOKEN_FILE, "w") as token:
-                token.write(creds.to_json())
+# One <email>.json token per mirrored account
+TOKEN_DIR = "tokens"
+# Refresh this long before the access token actually expires
+REFRESH_MARGIN = timedelta(minutes=5)
+
+REDIRECT_URI = "http://localhost:8000/oauth2callback"
+
+# Parsed from CLIENT_SECRETS_FILE on the first /login, not at import, so
+# workers start (and sync) without the secrets file present.
+_flow = None
+_flow_lock = threading.Lock()
+
+# Process-wide cache of parsed tokens per account; each account's lock makes
+# its refresh single-flight.
+_creds = {}
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def get_flow():
+    global _flow
+    with _flow_lock:
+        if _flow is None:
+            if not os.path.exists(CLIENT_SECRETS_FILE):
+                raise HTTPException(500, f"OAuth client secrets file {CLIENT_SECRETS_FILE} not found")
+            from google_auth_oauthlib.flow import Flow
+            _flow = Flow.from_client_secrets_file(CLIENT_SECRETS_FILE, scopes=SCOPES, redirect_uri=REDIRECT_URI)
+        return _flow
+
+
+def _token_path(user_email):
+    # Account names arrive in query strings and Pub/Sub payloads; never let
+    # one name a file outside TOKEN_DIR.
+    if not user_email or user_email.startswith(".") or "/" in user_email or "\\" in user_email:
+        raise HTTPException(400, f"Invalid account name: {user_email!r}")
+    return os.path.join(TOKEN_DIR, f"{user_email}.json")
+
+
+def _lock_for(user_email):
+    with _locks_guard:
+        return _locks.setdefault(user_email, threading.Lock())
+
+
+def _needs_refresh(creds):
+    if not creds.valid:
+        return True
+    return creds.expiry is not None and creds.expiry - REFRESH_MARGIN <= datetime.utcnow()
+
+
+def _write_token(user_email, creds):
+    # Write to a temp file and rename so readers never see a partial token.
+    os.makedirs(TOKEN_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=TOKEN_DIR, prefix=".token-", suffix=".json")
+    try:
+        with os.fdopen(fd, "w") as token:
+            token.write(creds.to_json())
+        os.replace(tmp_path, _token_path(user_email))
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _refresh(user_email, creds):
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        creds.refresh(Request())
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        TOKEN_REFRESHES.inc(outcome=outcome)
+        TOKEN_REFRESH_SECONDS.observe(elapsed)
+    log.info("access token refreshed", extra={"account": user_email, "ms": round(elapsed * 1000)})
+    _write_token(user_email, creds)
+
+
+def list_accounts():
+    if not os.path.isdir(TOKEN_DIR):
+        return []
+    return sorted(f[:-len(".json")] for f in os.listdir(TOKEN_DIR)
+                  if f.endswith(".json") and not f.startswith("."))
+
+
+def resolve_account(user_email=None):
+    """The given account, or the only stored one when the caller did not name one."""
+    accounts = list_accounts()
+    if user_email:
+        if user_email not in accounts:
+            raise HTTPException(404, f"Account {user_email} is not authenticated. Use /login first.")
+        return user_email
+    if len(accounts) > 1:
+        raise HTTPException(400, "Several accounts are authenticated; pass ?account=<email>.")
+    return accounts[0] if accounts else None
+
+
+def get_credentials(user_email=None):
+    if user_email:
+        # Cached tokens skip listing TOKEN_DIR; the name is still checked first
+        _token_path(user_email)
+        creds = _creds.get(user_email)
+        if creds and not _needs_refresh(creds):
             return creds
-    return None
\ No newline at end of file
+
+    user_email = resolve_account(user_email)
+    if not user_email:
+        return None
+
+    creds = _creds.get(user_email)
+    if creds and not _needs_refresh(creds):
+        return creds
+
+    with _lock_for(user_email):
+        # Another thread may have loaded or refreshed while we waited.
+        creds = _creds.get(user_email)
+        if creds is None:
+            path = _token_path(user_email)
+            if not os.path.exists(path):
+                return None
+            creds = _creds[user_email] = Credentials.from_authorized_user_file(path, SCOPES)
+        if _needs_refresh(creds):
+            if not creds.refresh_token:
+                return creds if creds.valid else None
+            _refresh(user_email, creds)
+        return creds
+
+
+def account_of(creds):
+    """The account whose cached credentials object `creds` is, or None."""
+    for user_email, cached in list(_creds.items()):
+        if cached is creds:
+            return user_email
+    return None
+
+
+def save_credentials(user_email, creds):
+    with _lock_for(user_email):
+        _write_token(user_email, creds)
+        _creds[user_email] = creds
+
+
+def clear_credentials(user_email):
+    with _lock_for(user_email):
+        _creds.pop(user_email, None)
+        path = _token_path(user_email)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,454 @@
+"""
+Offline benchmarks for sync, ingestion and the read API, run against the
+fake Gmail server in fake_gmail.py.
+
+    python bench.py                                   # SQLite, 10k messages, every scenario
+    python bench.py --sizes 10000,100000 --db sqlite --db postgresql://bench@localhost/bench
+    python bench.py --scenarios resync,history --latency 0.02 --error-rate 0.01
+    python bench.py --scenarios startup --runs 20             # cold import and first request
+    python bench.py --compare bench_results/old.json bench_results/new.json
+
+Each database runs in its own subprocess (DATABASE_URL is read at import).
+Gmail quotas are lifted unless --gmail-quota is given, so the numbers
+measure this code rather than the throttle. Results are written as JSON
+together with the git commit, for comparing runs between commits.
+"""
+import argparse, json, os, platform, socket, subprocess, sys, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+SCENARIOS = ["resync", "history", "pubsub", "listing", "startup"]
+RESULTS_DIR = "bench_results"
+# Relative slowdown reported as a regression by --compare
+REGRESSION_THRESHOLD = 0.10
+USER_EMAIL = "me@example.com"
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def latency_summary(samples, seconds):
+    return {
+        "requests": len(samples),
+        "requests_per_second": round(len(samples) / seconds, 1) if seconds else None,
+        "p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "p95_ms": round(percentile(samples, 95) * 1000, 2),
+        "p99_ms": round(percentile(samples, 99) * 1000, 2),
+    }
+
+
+def _git(*args):
+    try:
+        return subprocess.run(
+            ["git", *args], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+# ---------------- scenario runner (child process) ----------------
+
+# Runs in a fresh interpreter per startup sample; prints seconds per phase.
+STARTUP_PROBE = """
+import json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+client = TestClient(main.create_app())
+ready_to_start = time.perf_counter()
+with client:
+    up = time.perf_counter()
+    client.get("/emails?limit=50").raise_for_status()
+    first = time.perf_counter()
+    client.get("/emails?limit=50").raise_for_status()
+    second = time.perf_counter()
+print(json.dumps({
+    "import": imported - started,
+    "startup": up - ready_to_start,
+    "first_request": first - up,
+    "second_request": second - first,
+}))
+"""
+
+class Bench:
+    def __init__(self, args):
+        import fake_gmail
+        self.args = args
+        self.mailbox = fake_gmail.FakeMailbox(0)
+        self.fake_server, endpoint = fake_gmail.serve(self.mailbox)
+        os.environ["GMAIL_API_ENDPOINT"] = endpoint
+
+        from google.oauth2.credentials import Credentials
+        self.creds = Credentials(token="bench")
+        self.api = None
+        self.api_server = None
+
+    def use_mailbox(self, size):
+        import fake_gmail
+        self.mailbox = fake_gmail.FakeMailbox(size, self.args.latency, self.args.error_rate, self.args.seed)
+        self.fake_server.RequestHandlerClass.mailbox = self.mailbox
+        return self.mailbox
+
+    def reset_db(self):
+        from database import get_engine
+        from models import Base
+        from init_db import init_db
+        from cache import MemoryCache, set_cache
+
+        engine = get_engine()
+        engine.dispose()
+        if engine.dialect.name == "sqlite" and engine.url.database:
+            if os.path.exists(engine.url.database):
+                os.remove(engine.url.database)
+        else:
+            Base.metadata.drop_all(bind=engine)
+        init_db(engine)
+        set_cache(MemoryCache())
+
+    def gmail_calls(self):
+        from gmail_service import quota_stats
+        return {m: v.get("calls", 0) for m, v in quota_stats()["methods"].items()}
+
+    def calls_since(self, before):
+        after = self.gmail_calls()
+        return {m: n - before.get(m, 0) for m, n in after.items() if n - before.get(m, 0)}
+
+    def resync(self, size):
+        from gmail_utils import fetch_and_store_emails
+        self.use_mailbox(size)
+        self.reset_db()
+        before = self.gmail_calls()
+        started = time.perf_counter()
+        inserted = fetch_and_store_emails(self.creds)
+        seconds = time.perf_counter() - started
+        return {
+            "seconds": round(seconds, 3),
+            "inserted": inserted,
+            "messages_per_second": round(inserted / seconds, 1),
+            "gmail_calls": self.calls_since(before),
+        }
+
+    def _synced_mailbox(self, size):
+        from gmail_utils import fetch_and_store_emails, _get_or_create_sync_state
+        from database import SessionLocal
+        self.use_mailbox(size)
+        self.reset_db()
+        fetch_and_store_emails(self.creds)
+        db = SessionLocal()
+        try:
+            return _get_or_create_sync_state(db, self.creds).last_history_id
+        finally:
+            db.close()
+
+    def history(self, size):
+        from gmail_utils import sync_history
+        start_history_id = self._synced_mailbox(size)
+        burst = self.args.burst
+        changes = self.mailbox.simulate(
+            adds=burst * 3 // 10, label_changes=burst * 6 // 10, deletes=burst - burst * 9 // 10
+        )
+        before = self.gmail_calls()
+        started = time.perf_counter()
+        sync_history(self.creds, start_history_id)
+        seconds = time.perf_counter() - started
+        return {
+            "seconds": round(seconds, 3),
+            "changes": changes,
+            "changes_per_second": round(changes / seconds, 1),
+            "gmail_calls": self.calls_since(before),
+        }
+
+    def start_api(self):
+        if self.api:
+            return self.api
+        import uvicorn, main
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        # lifespan off: the pubsub scenario starts the sync workers itself
+        config = uvicorn.Config(main.app, host="127.0.0.1", port=port, lifespan="off", log_level="warning")
+        self.api_server = uvicorn.Server(config)
+        threading.Thread(target=self.api_server.run, daemon=True).start()
+        while not self.api_server.started:
+            time.sleep(0.05)
+        self.api = f"http://127.0.0.1:{port}"
+        return self.api
+
+    def _load(self, urls, method="GET", bodies=None):
+        """Issue requests from --concurrency threads; returns (latencies, seconds)."""
+        import requests
+        local = threading.local()
+
+        def one(i):
+            session = getattr(local, "session", None) or requests.Session()
+            local.session = session
+            started = time.perf_counter()
+            if method == "POST":
+                response = session.post(urls[i], json=bodies[i])
+            else:
+                response = session.get(urls[i])
+            response.raise_for_status()
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            latencies = list(pool.map(one, range(len(urls))))
+        return latencies, time.perf_counter() - started
+
+    def pubsub(self, size):
+        import base64
+        import sync_worker
+        from database import SessionLocal
+        from models import SyncJob, SyncState
+        from metrics import PUBSUB_TO_COMMIT_SECONDS
+
+        self._synced_mailbox(size)
+        api = self.start_api()
+        sync_worker.get_credentials = lambda *a: self.creds
+        sync_worker.start_workers()
+        try:
+            notifications = self.args.notifications
+            bodies = []
+            for _ in range(notifications):
+                self.mailbox.simulate(adds=1)
+                data = json.dumps({"emailAddress": USER_EMAIL, "historyId": self.mailbox.history_id})
+                bodies.append({"message": {"data": base64.b64encode(data.encode()).decode()}})
+            syncs_before = PUBSUB_TO_COMMIT_SECONDS.count()
+
+            started = time.perf_counter()
+            latencies, post_seconds = self._load([api + "/gmail/pubsub"] * notifications, "POST", bodies)
+            target = self.mailbox.history_id
+            db = SessionLocal()
+            try:
+                while True:
+                    open_jobs = db.query(SyncJob).filter(SyncJob.status.in_(["pending", "running"])).count()
+                    state = db.query(SyncState).filter_by(user_email=USER_EMAIL).first()
+                    db.rollback()
+                    if not open_jobs and state and int(state.last_history_id) >= target:
+                        break
+                    time.sleep(0.05)
+            finally:
+                db.close()
+            drain_seconds = time.perf_counter() - started
+        finally:
+            sync_worker.stop_workers()
+
+        syncs = PUBSUB_TO_COMMIT_SECONDS.count() - syncs_before
+        return {
+            "notifications": notifications,
+            "seconds": round(drain_seconds, 3),
+            "notify": latency_summary(latencies, post_seconds),
+            "sync_runs": syncs,
+        }
+
+    def listing(self, size):
+        from cache import MemoryCache, set_cache
+        self._synced_mailbox(size)
+        api = self.start_api()
+        import requests
+
+        # A cursor walk down the mailbox, plus filtered first pages
+        urls, cursor = [], None
+        session = requests.Session()
+        while len(urls) < self.args.requests // 2:
+            url = api + "/emails?limit=50" + (f"&cursor={cursor}" if cursor else "")
+            urls.append(url)
+            cursor = session.get(url).json()["next_cursor"]
+        for i in range(self.args.requests - len(urls)):
+            kind = i % 4
+            if kind == 0:
+                urls.append(api + f"/emails?from_email=sender{i % 50}@example.com")
+            elif kind == 1:
+                urls.append(api + "/emails?label=INBOX&limit=100")
+            elif kind == 2:
+                urls.append(api + f"/emails/{1 + i % max(size, 1)}")
+            else:
+                urls.append(api + "/emails?is_starred=0&limit=20")
+
+        results = {}
+        for variant, backend in (("uncached", MemoryCache(maxsize=0)), ("cached", MemoryCache())):
+            set_cache(backend)
+            latencies, seconds = self._load(urls)
+            results[variant] = latency_summary(latencies, seconds)
+        return results
+
+    def startup(self, size):
+        """
+        Cold start of an API worker, each run in a fresh interpreter: import
+        of main, lifespan startup, then the first and second /emails request.
+        """
+        self._synced_mailbox(size)
+        bench_dir = os.path.dirname(os.path.abspath(__file__))
+        samples = {"import": [], "startup": [], "first_request": [], "second_request": []}
+        for _ in range(self.args.runs):
+            output = subprocess.run(
+                [sys.executable, "-c", STARTUP_PROBE], cwd=bench_dir, env=dict(os.environ),
+                check=True, capture_output=True, text=True,
+            ).stdout
+            for name, seconds in json.loads(output.strip().splitlines()[-1]).items():
+                samples[name].append(seconds * 1000)
+        return {
+            "runs": self.args.runs,
+            **{f"{name}_ms": {"p50": round(percentile(v, 50), 1), "p95": round(percentile(v, 95), 1)}
+               for name, v in samples.items()},
+        }
+
+    def run(self):
+        results = []
+        for scenario in self.args.scenarios:
+            for size in self.args.sizes:
+                print(f"⏱️  {scenario} size={size} db={self.args.db_label}", file=sys.stderr)
+                entry = {"scenario": scenario, "size": size, "db": self.args.db_label}
+                try:
+                    entry.update(getattr(self, scenario)(size))
+                except Exception as e:
+                    entry["error"] = f"{type(e).__name__}: {e}"
+                results.append(entry)
+        if self.api_server:
+            self.api_server.should_exit = True
+        return results
+
+
+def _child(args):
+    results = Bench(args).run()
+    with open(args.child_out, "w") as f:
+        json.dump(results, f)
+
+
+# ---------------- driver ----------------
+
+def _db_url(db, workdir):
+    if db == "sqlite":
+        return f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    return db
+
+
+def _db_label(url):
+    return url.split(":", 1)[0].split("+", 1)[0]
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="gmail-bench-")
+    results = []
+    for db in args.db or ["sqlite"]:
+        url = _db_url(db, workdir)
+        env = dict(os.environ, DATABASE_URL=url, LOG_LEVEL="WARNING",
+                   ATTACHMENTS_DIR=os.path.join(workdir, "attachments"))
+        if args.gmail_quota is None:
+            env.update(GMAIL_USER_QUOTA="1000000000", RESYNC_GETS_PER_SECOND="1000000000")
+        else:
+            env["GMAIL_USER_QUOTA"] = str(args.gmail_quota)
+        child_out = os.path.join(workdir, f"{_db_label(url)}.json")
+        cmd = [
+            sys.executable, os.path.abspath(__file__), "--child-out", child_out,
+            "--db-label", _db_label(url),
+            "--scenarios", ",".join(args.scenarios), "--sizes", ",".join(map(str, args.sizes)),
+            "--latency", str(args.latency), "--error-rate", str(args.error_rate), "--seed", str(args.seed),
+            "--burst", str(args.burst), "--notifications", str(args.notifications),
+            "--requests", str(args.requests), "--concurrency", str(args.concurrency),
+            "--runs", str(args.runs),
+        ]
+        subprocess.run(cmd, env=env, check=True)
+        with open(child_out) as f:
+            results.extend(json.load(f))
+
+    report = {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "created_at": datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: getattr(args, k) for k in (
+            "scenarios", "sizes", "latency", "error_rate", "seed", "burst",
+            "notifications", "requests", "concurrency", "gmail_quota", "runs",
+        )},
+        "results": results,
+    }
+    out = args.out
+    if not out:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        out = os.path.join(RESULTS_DIR, f"{stamp}-{(report['commit'] or 'nogit')[:10]}.json")
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    for entry in results:
+        print(json.dumps(entry))
+    print(f"📝 Results written to {out}")
+
+
+def _headline(entry):
+    """(metric name, value) where lower is better, for comparing runs."""
+    if entry.get("scenario") == "listing":
+        return "uncached p95_ms", (entry.get("uncached") or {}).get("p95_ms")
+    if entry.get("scenario") == "startup":
+        phases = [entry.get(f"{name}_ms", {}).get("p50") for name in ("import", "startup", "first_request")]
+        return "cold start p50_ms", None if None in phases else round(sum(phases), 1)
+    return "seconds", entry.get("seconds")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    key = lambda e: (e["scenario"], e["db"], e["size"])
+    baseline = {key(e): e for e in old["results"]}
+    regressions = 0
+    print(f"{(old.get('commit') or '?')[:10]} -> {(new.get('commit') or '?')[:10]}")
+    for entry in new["results"]:
+        before = baseline.get(key(entry))
+        metric, value = _headline(entry)
+        previous = _headline(before)[1] if before else None
+        if value is None or not previous:
+            print(f"  {entry['scenario']:8} {entry['db']:10} {entry['size']:>7}  {metric}: n/a")
+            continue
+        change = (value - previous) / previous
+        flag = "  REGRESSION" if change > REGRESSION_THRESHOLD else ""
+        regressions += bool(flag)
+        print(f"  {entry['scenario']:8} {entry['db']:10} {entry['size']:>7}  "
+              f"{metric}: {previous} -> {value} ({change:+.1%}){flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline sync/API benchmarks against fake_gmail")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda s: [x for x in s.split(",") if x])
+    parser.add_argument("--sizes", default="10000", type=lambda s: [int(x) for x in s.split(",") if x],
+                        help="mailbox sizes, e.g. 10000,100000")
+    parser.add_argument("--db", action="append",
+                        help="'sqlite' or a SQLAlchemy URL; repeat to run several (default sqlite)")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake Gmail seconds per call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of Gmail calls answered 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--burst", type=int, default=1000, help="history changes per history scenario")
+    parser.add_argument("--notifications", type=int, default=500, help="Pub/Sub pushes per storm")
+    parser.add_argument("--requests", type=int, default=2000, help="listing requests per variant")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--runs", type=int, default=10, help="cold starts per startup scenario")
+    parser.add_argument("--gmail-quota", type=float, help="per-user quota units/s (default: unthrottled)")
+    parser.add_argument("--out", help=f"result file (default {RESULTS_DIR}/<time>-<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--child-out", help=argparse.SUPPRESS)
+    parser.add_argument("--db-label", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+    if args.child_out:
+        _child(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
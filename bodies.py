@@ -0,0 +1,107 @@
+import os, re, base64, zlib
+from sqlalchemy import insert
+from models import Email, EmailBody
+
+# zlib needs nothing extra; zstd (smaller and faster) needs the zstandard
+# package. The codec is stored per row, so switching never breaks reads.
+BODY_CODEC = os.getenv("BODY_CODEC", "zlib")
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+
+_CHARSET = re.compile(r'charset="?([\w.:-]+)', re.I)
+
+
+def compress(data, codec=BODY_CODEC):
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(data, codec):
+    if data is None:
+        return None
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _charset(part):
+    for header in part.get("headers", []) or []:
+        if header["name"].lower() == "content-type":
+            match = _CHARSET.search(header["value"])
+            if match:
+                return match.group(1)
+    return "utf-8"
+
+
+def _decode(part):
+    data = base64.urlsafe_b64decode(part["body"]["data"])
+    try:
+        return data.decode(_charset(part), errors="replace")
+    except LookupError:
+        return data.decode("utf-8", errors="replace")
+
+
+def extract_bodies(payload):
+    """Return (text, html) of a format="full" payload; either may be None."""
+    found = {"text/plain": [], "text/html": []}
+    stack = [payload or {}]
+    while stack:
+        part = stack.pop()
+        stack.extend(reversed(part.get("parts", []) or []))
+        mime_type = part.get("mimeType")
+        body = part.get("body", {}) or {}
+        # Text attachments (with a filename) are not the message body
+        if mime_type in found and not part.get("filename") and body.get("data"):
+            found[mime_type].append(_decode(part))
+    text = "\n".join(found["text/plain"]) or None
+    html = "\n".join(found["text/html"]) or None
+    return text, html
+
+
+def store_bodies(db, account_id, messages, codec=BODY_CODEC):
+    """
+    Decode, compress and insert the bodies of freshly inserted messages
+    ({message_id: format="full" resource}). The caller commits.
+    """
+    if not messages:
+        return 0
+    email_ids = dict(
+        db.query(Email.message_id, Email.id)
+        .filter(Email.account_id == account_id, Email.message_id.in_(list(messages)))
+        .all()
+    )
+
+    rows = []
+    for msg_id, msg in messages.items():
+        text, html = extract_bodies(msg.get("payload"))
+        if msg_id not in email_ids or (text is None and html is None):
+            continue
+        text_bytes = text.encode() if text is not None else None
+        html_bytes = html.encode() if html is not None else None
+        rows.append(dict(
+            email_id=email_ids[msg_id],
+            codec=codec,
+            text=compress(text_bytes, codec) if text_bytes is not None else None,
+            html=compress(html_bytes, codec) if html_bytes is not None else None,
+            text_size=len(text_bytes) if text_bytes is not None else None,
+            html_size=len(html_bytes) if html_bytes is not None else None,
+        ))
+    if rows:
+        db.execute(insert(EmailBody), rows)
+    return len(rows)
+
+
+def load_body(db, email_id):
+    """Decompressed {"text", "html"} for an email, or None if no body is stored."""
+    row = db.get(EmailBody, email_id)
+    if row is None:
+        return None
+    text = decompress(row.text, row.codec)
+    html = decompress(row.html, row.codec)
+    return {
+        "text": text.decode() if text is not None else None,
+        "html": html.decode() if html is not None else None,
+    }
@@ -0,0 +1,182 @@
+import os, time, hashlib, threading
+from collections import OrderedDict
+
+# Response cache for the read endpoints. Entries are JSON bodies; the ETag is
+# derived from the body, so a client's If-None-Match is answered with a 304
+# whether or not the entry was in the cache.
+#
+#   CACHE_URL unset            in-process LRU with a TTL; syncs committed by
+#                              other processes reach it through the change feed
+#                              (see main._follow_changes), up to a poll late
+#   CACHE_URL=redis://...      shared Redis (needs the redis package)
+CACHE_URL = os.getenv("CACHE_URL")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "300"))
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", "10000"))
+
+# Listing keys embed this counter; bumping it orphans every cached page.
+LISTING_GENERATION_KEY = "emails:generation"
+
+
+class MemoryCache:
+    """Thread-safe LRU of bytes values with a per-entry TTL."""
+
+    def __init__(self, maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # Counters live outside the LRU: evicting one would reset it and
+        # resurrect listings cached under an old generation.
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._counters:
+                return str(self._counters[key]).encode()
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def get_many(self, keys):
+        return [self.get(k) for k in keys]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (ttl or self.ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._counters.clear()
+
+    def drop_entries(self):
+        """Drop every entry but keep the counters, so generations only move forward."""
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    """
+    Same interface over a Redis client. Any redis-py compatible client works,
+    e.g. fakeredis.FakeRedis() to run without a server.
+    """
+
+    def __init__(self, client=None, url=CACHE_URL, ttl=CACHE_TTL):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def get_many(self, keys):
+        return self.client.mget(keys) if keys else []
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=ttl or self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*keys)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+    def clear(self):
+        self.client.flushdb()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = RedisCache() if CACHE_URL else MemoryCache()
+    return _cache
+
+
+def set_cache(backend):
+    """Swap the backend (e.g. RedisCache(fakeredis.FakeRedis()))."""
+    global _cache
+    _cache = backend
+
+
+def etag_for(body):
+    return '"{}"'.format(hashlib.blake2b(body, digest_size=16).hexdigest())
+
+
+def email_key(email_id):
+    return f"email:{email_id}"
+
+
+def _message_tag(account_id, message_id):
+    # Sync only knows Gmail message ids; this maps one to its detail entry.
+    return f"msg:{account_id}:{message_id}"
+
+
+def generation():
+    return int(get_cache().get(LISTING_GENERATION_KEY) or 0)
+
+
+def listing_key(prefix, params):
+    # Taken before the query runs: a page built while a sync commits is
+    # stored under the old generation, which no later request reads.
+    digest = hashlib.sha1(repr(sorted(params)).encode()).hexdigest()
+    return f"{prefix}:{generation()}:{digest}"
+
+
+def cache_email(email, body):
+    cache = get_cache()
+    cache.set(email_key(email.id), body)
+    cache.set(_message_tag(email.account_id, email.message_id), email_key(email.id).encode())
+
+
+def invalidate_all():
+    """
+    Drop every cached response of this process's MemoryCache, after changes
+    some other process committed. The generation moves first, so a detail
+    read that started before the changes is not cached afterwards.
+    """
+    cache = get_cache()
+    cache.incr(LISTING_GENERATION_KEY)
+    cache.drop_entries()
+
+
+def invalidate_messages(account_id, message_ids):
+    """
+    Drop cached detail responses for the given Gmail message ids and every
+    cached listing. Call after the sync has committed its changes.
+    """
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+    cache = get_cache()
+    tags = [_message_tag(account_id, m) for m in message_ids]
+    entries = [key.decode() for key in cache.get_many(tags) if key]
+    cache.delete(*tags, *entries)
+    cache.incr(LISTING_GENERATION_KEY)
@@ -0,0 +1,97 @@
+import os, time
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select, func, text
+from sqlalchemy.orm import selectinload
+from models import Account, Email, EmailChange
+from schemas import EmailSchema, EmailChangeSchema, EmailChangePageSchema
+
+# GET /emails/changes: long-poll requests and SSE streams re-check the feed
+# every CHANGES_POLL_INTERVAL seconds. Polling the database, rather than an
+# in-process signal, also picks up syncs committed by other processes.
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "1"))
+CHANGES_MAX_WAIT = 60
+SSE_HEARTBEAT = 15
+CHANGE_RETENTION = timedelta(days=int(os.getenv("CHANGE_RETENTION_DAYS", "30")))
+PRUNE_INTERVAL = 3600
+
+# Any constant works; it only has to be the same in every process.
+_SEQ_LOCK_KEY = 0x656D61696C73
+_last_prune = 0.0
+
+
+def record_changes(db, account_id, op, email_ids):
+    """
+    Append `op` for {message_id: email id} to the change feed, in db's
+    transaction. Call right before commit: on PostgreSQL this takes a lock
+    held until commit, so writers get their seqs in commit order and a
+    reader past seq N never finds a smaller one appear later.
+    """
+    if not email_ids:
+        return
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _SEQ_LOCK_KEY})
+    now = datetime.utcnow()
+    db.execute(insert(EmailChange), [
+        {"account_id": account_id, "email_id": email_id, "message_id": message_id, "op": op, "changed_at": now}
+        for message_id, email_id in email_ids.items()
+    ])
+
+
+def prune_changes(db):
+    """Drop changes older than CHANGE_RETENTION, at most once per PRUNE_INTERVAL."""
+    global _last_prune
+    if time.monotonic() - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = time.monotonic()
+    # The newest row always stays, so is_expired() can tell a pruned seq
+    # from one that was never handed out.
+    newest = db.query(func.max(EmailChange.seq)).scalar()
+    if newest is None:
+        return
+    db.query(EmailChange).filter(
+        EmailChange.changed_at < datetime.utcnow() - CHANGE_RETENTION,
+        EmailChange.seq < newest,
+    ).delete(synchronize_session=False)
+    db.commit()
+
+
+async def latest_seq(db):
+    """The newest seq in the feed, or None while it is empty."""
+    return await db.scalar(select(func.max(EmailChange.seq)))
+
+
+async def is_expired(db, since):
+    """True if changes after `since` were pruned; the client has to start over from /emails."""
+    if not since:
+        return False
+    oldest = await db.scalar(select(func.min(EmailChange.seq)))
+    return oldest is not None and oldest > since + 1
+
+
+async def read_changes(db, since, account=None, limit=500):
+    """Changes after seq `since`, oldest first, each with the email's current state."""
+    stmt = select(EmailChange).where(EmailChange.seq > since)
+    if account is not None:
+        account_id = select(Account.id).where(Account.email == account).scalar_subquery()
+        stmt = stmt.where(EmailChange.account_id == account_id)
+    changes = (await db.scalars(stmt.order_by(EmailChange.seq).limit(limit))).all()
+
+    email_ids = {c.email_id for c in changes if c.op != "delete"}
+    emails = {}
+    if email_ids:
+        result = await db.scalars(
+            select(Email)
+            .options(selectinload(Email.attachments), selectinload(Email.labels))
+            .where(Email.id.in_(email_ids))
+        )
+        emails = {e.id: EmailSchema.model_validate(e, from_attributes=True) for e in result}
+
+    items = [
+        EmailChangeSchema(
+            seq=c.seq, op=c.op, account_id=c.account_id, email_id=c.email_id,
+            message_id=c.message_id, changed_at=c.changed_at,
+            email=emails.get(c.email_id) if c.op != "delete" else None,
+        )
+        for c in changes
+    ]
+    return EmailChangePageSchema(items=items, next_since=items[-1].seq if items else since)
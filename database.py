@@ -1,8 +1,121 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import os, threading, time
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from metrics import DB_QUERY_SECONDS, DB_COMMIT_SECONDS
+
+DATABASE_URL = os.getenv("DATABASE_URL", "Your database URL")
+
+# Connection pool, per engine and per process. The sync engine serves the
+# background workers and threadpool routes, the async engine the async
+# routes; pool_size + max_overflow bounds each side's concurrent queries.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "30"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# Async driver for the same database
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def _async_url(url):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+def _pool_options(url):
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+
+def _instrument(engine):
+    if engine.dialect.name == "sqlite":
+        # SQLite ignores ON DELETE CASCADE unless foreign keys are switched on
+        # per connection; labels, bodies and attachments rely on it.
+        @event.listens_for(engine, "connect")
+        def _enable_foreign_keys(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA foreign_keys=ON")
+            cursor.close()
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _query_started(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _query_finished(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        DB_QUERY_SECONDS.observe(elapsed, statement=statement.lstrip().split(None, 1)[0].upper())
+
+
+# Engines are created on first use, in the process (worker) that uses them,
+# so importing this module neither loads database drivers nor touches the DB.
+_engine = None
+_async_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(DATABASE_URL, **_pool_options(DATABASE_URL))
+            _instrument(_engine)
+        return _engine
+
+
+def get_async_engine():
+    global _async_engine
+    with _engine_lock:
+        if _async_engine is None:
+            _async_engine = create_async_engine(_async_url(DATABASE_URL), **_pool_options(DATABASE_URL))
+            _instrument(_async_engine.sync_engine)
+        return _async_engine
+
+
+async def dispose_engines():
+    """Close both pools; the next session opens fresh ones."""
+    global _engine, _async_engine
+    with _engine_lock:
+        engine, async_engine = _engine, _async_engine
+        _engine = _async_engine = None
+    if async_engine is not None:
+        await async_engine.dispose()
+    if engine is not None:
+        engine.dispose()
+
+
+# AsyncSession drives a Session underneath, so this times both kinds of commit.
+@event.listens_for(Session, "before_commit")
+def _commit_started(session):
+    session.info["commit_started"] = time.perf_counter()
+
+
+@event.listens_for(Session, "after_commit")
+def _commit_finished(session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+
+_session_factory = sessionmaker()
+_async_session_factory = async_sessionmaker(class_=AsyncSession, expire_on_commit=False)
+
+
+def SessionLocal():
+    return _session_factory(bind=get_engine())
+
+
+def AsyncSessionLocal():
+    return _async_session_factory(bind=get_async_engine())
 
-DATABASE_URL = "Your database URL"
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(bind=engine)
 Base = declarative_base()
@@ -0,0 +1,414 @@
+"""
+Minimal fake Gmail REST server for running syncs and benchmarks offline.
+
+    python fake_gmail.py --messages 5000 --port 8089
+    GMAIL_API_ENDPOINT=http://127.0.0.1:8089/ uvicorn main:app
+
+Implements users.getProfile, users.history.list, users.messages.list/get/send
+(JSON, multipart and resumable uploads), users.messages.attachments.get and
+the /batch/gmail/v1 multipart endpoint. Any OAuth token is accepted.
+Mailbox changes made through add_message/modify_labels/delete_message (or
+simulate) are recorded as history, like Gmail does.
+"""
+import argparse, base64, json, random, threading, time, uuid
+from email import message_from_bytes
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+USER_EMAIL = "me@example.com"
+DEFAULT_LABELS = ("INBOX", "CATEGORY_PERSONAL")
+HISTORY_KEYS = {
+    "messageAdded": "messagesAdded",
+    "messageDeleted": "messagesDeleted",
+    "labelAdded": "labelsAdded",
+    "labelRemoved": "labelsRemoved",
+}
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def _not_found():
+    return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+
+
+class FakeMailbox:
+    def __init__(self, size=1000, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.history_id = 1000
+        # Messages are stored compactly and rendered on request, so
+        # mailboxes of 100k+ messages fit in memory.
+        self.messages = {}
+        self.history = []
+        self.sent = []
+        self.uploads = {}
+        self.attachments = {}
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        for i in range(size):
+            self.add_message(
+                subject=f"Message {i}",
+                sender=f"sender{i % 50}@example.com",
+                date=start + timedelta(minutes=i),
+                record=False,
+            )
+        # Like an expired startHistoryId, anything older answers 404.
+        self.history_floor = self.history_id
+
+    # ---- Mailbox changes ----
+
+    def _record(self, **change):
+        self.history.append(dict(change, id=self.history_id))
+
+    def _ref(self, msg_id):
+        msg = self.messages[msg_id]
+        return {"id": msg_id, "threadId": msg["threadId"], "labelIds": list(msg["labelIds"])}
+
+    def add_message(self, subject, sender, date, label_ids=DEFAULT_LABELS, attachments=(), record=True,
+                    thread_id=None):
+        """attachments: iterable of (filename, bytes). thread_id: reply into that thread."""
+        with self.lock:
+            self.history_id += 1
+            msg_id = format(self.history_id, "x")
+            parts = []
+            for i, (filename, data) in enumerate(attachments, start=1):
+                attachment_id = f"{msg_id}-att{i}"
+                self.attachments[attachment_id] = data
+                parts.append((str(i), filename, attachment_id, len(data)))
+            self.messages[msg_id] = {
+                "threadId": thread_id or msg_id,
+                "labelIds": list(label_ids),
+                "subject": subject,
+                "sender": sender,
+                "date": format_datetime(date),
+                "attachments": parts,
+                "historyId": self.history_id,
+            }
+            if record:
+                ref = self._ref(msg_id)
+                self._record(messages=[ref], messagesAdded=[{"message": ref}])
+            return msg_id
+
+    def modify_labels(self, msg_id, add=(), remove=()):
+        with self.lock:
+            msg = self.messages[msg_id]
+            add = [l for l in add if l not in msg["labelIds"]]
+            remove = [l for l in remove if l in msg["labelIds"]]
+            if not add and not remove:
+                return
+            self.history_id += 1
+            msg["labelIds"] = [l for l in msg["labelIds"] if l not in remove] + add
+            msg["historyId"] = self.history_id
+            ref = self._ref(msg_id)
+            change = {"messages": [ref]}
+            if add:
+                change["labelsAdded"] = [{"message": ref, "labelIds": add}]
+            if remove:
+                change["labelsRemoved"] = [{"message": ref, "labelIds": remove}]
+            self._record(**change)
+
+    def delete_message(self, msg_id):
+        with self.lock:
+            msg = self.messages.pop(msg_id, None)
+            if msg is None:
+                return
+            self.history_id += 1
+            ref = {"id": msg_id, "threadId": msg["threadId"], "labelIds": msg["labelIds"]}
+            self._record(messages=[ref], messagesDeleted=[{"message": ref}])
+
+    def simulate(self, adds=0, label_changes=0, deletes=0, labels=("STARRED", "IMPORTANT", "Label_1", "Label_2")):
+        """Apply a shuffled burst of random changes; returns the number applied."""
+        ops = ["add"] * adds + ["label"] * label_changes + ["delete"] * deletes
+        self.random.shuffle(ops)
+        now = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        for n, op in enumerate(ops):
+            if op == "add":
+                # Every third new message is a reply to an existing conversation
+                with self.lock:
+                    threads = [m["threadId"] for m in self.messages.values()] if n % 3 == 0 else []
+                self.add_message(f"Burst {n}", f"burst{n % 20}@example.com", now + timedelta(seconds=n),
+                                 thread_id=self.random.choice(threads) if threads else None)
+                continue
+            with self.lock:
+                ids = list(self.messages)
+            if not ids:
+                continue
+            msg_id = self.random.choice(ids)
+            if op == "delete":
+                self.delete_message(msg_id)
+            elif self.random.random() < 0.2:
+                # Archive or move back to the inbox
+                if "INBOX" in self.messages.get(msg_id, {}).get("labelIds", []):
+                    self.modify_labels(msg_id, remove=["INBOX"])
+                else:
+                    self.modify_labels(msg_id, add=["INBOX"])
+            else:
+                label = self.random.choice(labels)
+                if label in self.messages.get(msg_id, {}).get("labelIds", []):
+                    self.modify_labels(msg_id, remove=[label])
+                else:
+                    self.modify_labels(msg_id, add=[label])
+        return len(ops)
+
+    # ---- REST handlers: return (status, body) ----
+
+    def get_profile(self, query):
+        return 200, {
+            "emailAddress": USER_EMAIL,
+            "messagesTotal": len(self.messages),
+            "historyId": str(self.history_id),
+        }
+
+    def list_messages(self, query):
+        label_ids = set(query.get("labelIds", []))
+        max_results = int(query.get("maxResults", ["100"])[0])
+        offset = int(query.get("pageToken", ["0"])[0] or 0)
+
+        with self.lock:
+            ids = [(m, msg["threadId"]) for m, msg in reversed(self.messages.items())
+                   if label_ids <= set(msg["labelIds"])]
+        page = ids[offset:offset + max_results]
+        body = {
+            "messages": [{"id": m, "threadId": t} for m, t in page],
+            "resultSizeEstimate": len(ids),
+        }
+        if offset + max_results < len(ids):
+            body["nextPageToken"] = str(offset + max_results)
+        return 200, body
+
+    def list_history(self, query):
+        start = int(query.get("startHistoryId", ["0"])[0])
+        if start < self.history_floor:
+            return _not_found()
+        max_results = min(int(query.get("maxResults", ["100"])[0]), 500)
+        offset = int(query.get("pageToken", ["0"])[0] or 0)
+        wanted = [HISTORY_KEYS[t] for t in query.get("historyTypes", [])] or list(HISTORY_KEYS.values())
+
+        with self.lock:
+            records = []
+            for record in self.history:
+                if record["id"] <= start:
+                    continue
+                kept = {k: record[k] for k in wanted if k in record}
+                if kept:
+                    records.append(dict(kept, id=str(record["id"]), messages=record["messages"]))
+            current = self.history_id
+        page = records[offset:offset + max_results]
+        # Gmail leaves out "history" when nothing changed
+        body = {"historyId": str(current)}
+        if page:
+            body["history"] = page
+        if offset + max_results < len(records):
+            body["nextPageToken"] = str(offset + max_results)
+        return 200, body
+
+    def _resource(self, msg_id, msg, fmt):
+        headers = [
+            {"name": "Subject", "value": msg["subject"]},
+            {"name": "From", "value": msg["sender"]},
+            {"name": "To", "value": USER_EMAIL},
+            {"name": "Date", "value": msg["date"]},
+        ]
+        resource = {
+            "id": msg_id,
+            "threadId": msg["threadId"],
+            "labelIds": list(msg["labelIds"]),
+            "snippet": f"Snippet for {msg['subject']}",
+            "historyId": str(msg["historyId"]),
+        }
+        if fmt == "minimal":
+            return resource
+        if fmt == "metadata":
+            resource["payload"] = {"headers": headers}
+            return resource
+
+        text = f"{msg['subject']}\n\nBody of {msg['subject']} from {msg['sender']}.".encode()
+        html = f"<p><b>{msg['subject']}</b></p><p>Body of {msg['subject']} from {msg['sender']}.</p>".encode()
+        parts = [{"partId": "0", "mimeType": "multipart/alternative", "filename": "", "body": {"size": 0},
+                  "parts": [
+                      {"partId": "0.0", "mimeType": "text/plain", "filename": "",
+                       "headers": [{"name": "Content-Type", "value": 'text/plain; charset="UTF-8"'}],
+                       "body": {"size": len(text), "data": _b64(text)}},
+                      {"partId": "0.1", "mimeType": "text/html", "filename": "",
+                       "headers": [{"name": "Content-Type", "value": 'text/html; charset="UTF-8"'}],
+                       "body": {"size": len(html), "data": _b64(html)}},
+                  ]}]
+        for part_id, filename, attachment_id, size in msg["attachments"]:
+            parts.append({"partId": part_id, "mimeType": "application/octet-stream",
+                          "filename": filename,
+                          "body": {"size": size, "attachmentId": attachment_id}})
+        resource["payload"] = {"headers": headers, "mimeType": "multipart/mixed", "parts": parts}
+        return resource
+
+    def get_message(self, query, msg_id):
+        msg = self.messages.get(msg_id)
+        if not msg:
+            return _not_found()
+        return 200, self._resource(msg_id, msg, query.get("format", ["full"])[0])
+
+    def get_attachment(self, query, msg_id, attachment_id):
+        data = self.attachments.get(attachment_id)
+        if data is None:
+            return _not_found()
+        return 200, {"size": len(data), "data": _b64(data)}
+
+    def send_message(self, raw):
+        parsed = message_from_bytes(raw)
+        msg_id = self.add_message(
+            subject=str(parsed["Subject"] or ""),
+            sender=USER_EMAIL,
+            date=datetime.now(timezone.utc),
+            label_ids=["SENT"],
+        )
+        with self.lock:
+            self.sent.append({"id": msg_id, "size": len(raw), "raw": raw})
+        return 200, {"id": msg_id, "threadId": msg_id, "labelIds": ["SENT"]}
+
+    def dispatch(self, method, url, body=b""):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return 429, {"error": {"code": 429, "message": "User-rate limit exceeded",
+                                   "errors": [{"reason": "userRateLimitExceeded"}]}}
+
+        parts = urlsplit(url)
+        query = parse_qs(parts.query)
+        path = parts.path.strip("/").split("/")
+        # gmail/v1/users/me/<resource>[/<id>]
+        if path[:3] != ["gmail", "v1", "users"] or len(path) < 5:
+            return 404, {"error": {"code": 404, "message": "Not found"}}
+        resource = path[4:]
+
+        if method == "GET" and resource == ["profile"]:
+            return self.get_profile(query)
+        if method == "GET" and resource == ["history"]:
+            return self.list_history(query)
+        if method == "GET" and resource == ["messages"]:
+            return self.list_messages(query)
+        if method == "GET" and len(resource) == 2 and resource[0] == "messages":
+            return self.get_message(query, resource[1])
+        if method == "GET" and len(resource) == 4 and resource[2] == "attachments":
+            return self.get_attachment(query, resource[1], resource[3])
+        if method == "POST" and resource == ["messages", "send"]:
+            return self.send_message(base64.urlsafe_b64decode(json.loads(body)["raw"]))
+        return 404, {"error": {"code": 404, "message": "Not found"}}
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    mailbox = None
+    # Keep-alive, like googleapis.com; httplib2 reuses connections.
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._send(*self.mailbox.dispatch("GET", self.path))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = self.rfile.read(length)
+        path = urlsplit(self.path).path.rstrip("/")
+        if path == "/batch/gmail/v1":
+            return self._batch(payload)
+        if path.startswith("/upload/"):
+            return self._upload(payload)
+        self._send(*self.mailbox.dispatch("POST", self.path, payload))
+
+    def do_PUT(self):
+        # Resumable upload chunk: Content-Range: bytes <first>-<last>/<total>
+        length = int(self.headers.get("Content-Length", 0))
+        payload = self.rfile.read(length)
+        upload_id = parse_qs(urlsplit(self.path).query)["upload_id"][0]
+        buf = self.mailbox.uploads[upload_id]
+        buf.extend(payload)
+
+        total = self.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+        if total != "*" and len(buf) >= int(total):
+            del self.mailbox.uploads[upload_id]
+            return self._send(*self.mailbox.send_message(bytes(buf)))
+        self.send_response(308)
+        self.send_header("Range", f"bytes=0-{len(buf) - 1}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _upload(self, payload):
+        upload_type = parse_qs(urlsplit(self.path).query).get("uploadType", ["media"])[0]
+        if upload_type == "resumable":
+            upload_id = uuid.uuid4().hex
+            self.mailbox.uploads[upload_id] = bytearray()
+            self.send_response(200)
+            self.send_header("Location", f"http://{self.headers['Host']}{urlsplit(self.path).path}?uploadType=resumable&upload_id={upload_id}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if upload_type == "multipart":
+            # multipart/related: JSON metadata part, then the raw message part
+            envelope = message_from_bytes(
+                b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n"
+            )
+            media_part = payload.split(b"--" + envelope.get_boundary().encode())[2]
+            payload = media_part.split(b"\n\n", 1)[1][:-1]
+        self._send(*self.mailbox.send_message(payload))
+
+    def _batch(self, payload):
+        content_type = self.headers["Content-Type"]
+        envelope = message_from_bytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + payload
+        )
+        boundary = uuid.uuid4().hex
+        out = []
+        for part in envelope.get_payload():
+            request_line = part.get_payload().lstrip().split("\n", 1)[0].strip()
+            method, url, _ = request_line.split(" ", 2)
+            status, body = self.mailbox.dispatch(method, url)
+            content_id = part["Content-ID"].strip("<>")
+            out.append(
+                f"--{boundary}\r\n"
+                f"Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                f"Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(body)}\r\n"
+            )
+        out.append(f"--{boundary}--\r\n")
+        self._send(200, "".join(out).encode(), f"multipart/mixed; boundary={boundary}")
+
+
+def serve(mailbox, host="127.0.0.1", port=0):
+    """Start the fake server in a daemon thread. Returns (server, endpoint)."""
+    handler = type("Handler", (FakeGmailHandler,), {"mailbox": mailbox})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Gmail API server")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    args = parser.parse_args()
+
+    server, endpoint = serve(FakeMailbox(args.messages, args.latency, args.error_rate), port=args.port)
+    print(f"📡 Fake Gmail API listening on {endpoint}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,198 @@
+import os, asyncio, time
+import httplib2, httpx
+from fastapi import HTTPException
+from googleapiclient.errors import HttpError
+from starlette.concurrency import run_in_threadpool
+from auth import account_of, get_credentials
+from gmail_service import (
+    GMAIL_API_ENDPOINT, MAX_RETRIES, _bucket_for, _creds_key, _profile_cache, _profile_lock,
+    backoff_delay, is_rate_limited, is_retryable, quota_units, record_stats,
+)
+from metrics import GMAIL_REQUEST_SECONDS
+
+# Gmail REST calls made from request handlers go through one pooled
+# httpx.AsyncClient instead of a googleapiclient service per threadpool
+# thread. Background workers keep using gmail_service.
+GMAIL_HTTP_MAX_CONNECTIONS = int(os.getenv("GMAIL_HTTP_MAX_CONNECTIONS", "100"))
+GMAIL_HTTP_MAX_KEEPALIVE = int(os.getenv("GMAIL_HTTP_MAX_KEEPALIVE", "20"))
+GMAIL_HTTP_TIMEOUT = float(os.getenv("GMAIL_HTTP_TIMEOUT", "60"))
+
+API_ROOT = GMAIL_API_ENDPOINT.rstrip("/") + "/gmail/v1/users/me"
+UPLOAD_ROOT = GMAIL_API_ENDPOINT.rstrip("/") + "/upload/gmail/v1/users/me"
+
+_client = None
+_client_loop = None
+
+
+def get_client():
+    """The process-wide AsyncClient, created on first use in the running event loop."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    # Pooled connections belong to the loop that opened them
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client_loop = loop
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=GMAIL_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=GMAIL_HTTP_MAX_KEEPALIVE,
+            ),
+            timeout=GMAIL_HTTP_TIMEOUT,
+        )
+    return _client
+
+
+async def aclose():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _http_error(response):
+    """Wrap a failed response in the HttpError googleapiclient would raise."""
+    headers = {k.lower(): v for k, v in response.headers.items()}
+    headers["status"] = str(response.status_code)
+    return HttpError(httplib2.Response(headers), response.content, uri=str(response.url))
+
+
+async def _authorization(creds):
+    if not creds.valid:
+        # Refreshed by auth, under the account's single-flight lock, which
+        # also stores the new token; google-auth refreshes synchronously.
+        account = account_of(creds)
+        refreshed = await run_in_threadpool(get_credentials, account) if account else None
+        if not refreshed or not refreshed.valid:
+            raise HTTPException(401, "Gmail credentials expired. Use /login again.")
+        creds = refreshed
+    return {"Authorization": f"Bearer {creds.token}"}
+
+
+async def _call(creds, method, send, idempotent=True, units=None, ok=(200,)):
+    """
+    Async counterpart of gmail_service.execute(): `send(headers)` issues the
+    request and returns the httpx response. Same quota bucket, retries and
+    metrics as the blocking client.
+    """
+    units = units if units is not None else quota_units(method)
+    bucket = _bucket_for(_creds_key(creds))
+
+    for attempt in range(MAX_RETRIES + 1):
+        await bucket.acquire_async(units)
+        record_stats(method, calls=1, units=units)
+        error = None
+        outcome = "ok"
+        started = time.perf_counter()
+        try:
+            response = await send(await _authorization(creds))
+            if response.status_code not in ok:
+                raise _http_error(response)
+        except HttpError as e:
+            outcome = str(e.resp.status)
+            if is_rate_limited(e):
+                bucket.throttle()
+                record_stats(method, rate_limited=1)
+            retryable = is_retryable(e) if idempotent else is_rate_limited(e)
+            if not retryable or attempt == MAX_RETRIES:
+                record_stats(method, errors=1)
+                raise
+            error = e
+        except httpx.TransportError:
+            outcome = "network_error"
+            if not idempotent or attempt == MAX_RETRIES:
+                record_stats(method, errors=1)
+                raise
+        else:
+            bucket.recover()
+            return response
+        finally:
+            GMAIL_REQUEST_SECONDS.observe(time.perf_counter() - started, method=method, outcome=outcome)
+
+        record_stats(method, retries=1)
+        await asyncio.sleep(backoff_delay(attempt, error))
+
+
+async def get_email_address(creds):
+    """users.getProfile emailAddress; shares gmail_service's profile cache."""
+    key = _creds_key(creds)
+    with _profile_lock:
+        email = _profile_cache.get(key)
+    if email:
+        return email
+
+    client = get_client()
+    response = await _call(
+        creds, "gmail.users.getProfile",
+        lambda headers: client.get(f"{API_ROOT}/profile", headers=headers),
+    )
+    email = response.json()["emailAddress"]
+    with _profile_lock:
+        _profile_cache[key] = email
+    return email
+
+
+async def _read(path, offset, size):
+    def read():
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+    return await run_in_threadpool(read)
+
+
+async def send_message_file(creds, path, resumable_threshold, chunk_size):
+    """
+    users.messages.send for an RFC 822 message spooled at `path`. Small
+    messages go up in one multipart request, larger ones as a resumable
+    upload in `chunk_size` pieces. Not retried on network errors, like
+    execute(idempotent=False).
+    """
+    client = get_client()
+    size = os.path.getsize(path)
+    method = "gmail.users.messages.send"
+
+    if size <= resumable_threshold:
+        raw = await _read(path, 0, size)
+        boundary = "===============" + os.urandom(16).hex() + "=="
+        body = (
+            f"--{boundary}\nContent-Type: application/json\nMIME-Version: 1.0\n\n{{}}\n"
+            f"--{boundary}\nContent-Type: message/rfc822\nMIME-Version: 1.0\n"
+            f"Content-Transfer-Encoding: binary\n\n"
+        ).encode() + raw + f"\n--{boundary}--".encode()
+        response = await _call(
+            creds, method,
+            lambda headers: client.post(
+                f"{UPLOAD_ROOT}/messages/send", params={"uploadType": "multipart"}, content=body,
+                headers={**headers, "Content-Type": f'multipart/related; boundary="{boundary}"'},
+            ),
+            idempotent=False,
+        )
+        return response.json()
+
+    start = await _call(
+        creds, method,
+        lambda headers: client.post(
+            f"{UPLOAD_ROOT}/messages/send", params={"uploadType": "resumable"}, json={},
+            headers={**headers, "X-Upload-Content-Type": "message/rfc822",
+                     "X-Upload-Content-Length": str(size)},
+        ),
+        idempotent=False,
+    )
+    session_url = start.headers["Location"]
+
+    offset = 0
+    while True:
+        chunk = await _read(path, offset, chunk_size)
+        last = offset + len(chunk) - 1
+        # The session was paid for by the initial request
+        response = await _call(
+            creds, method,
+            lambda headers: client.put(
+                session_url, content=chunk,
+                headers={**headers, "Content-Range": f"bytes {offset}-{last}/{size}"},
+            ),
+            idempotent=False, units=0, ok=(200, 201, 308),
+        )
+        if response.status_code != 308:
+            return response.json()
+        # 308 Resume Incomplete: carry on from what the server has stored
+        received = response.headers.get("Range")
+        offset = int(received.rsplit("-", 1)[1]) + 1 if received else 0
@@ -0,0 +1,214 @@
+import os, json, random, threading, time
+from collections import defaultdict
+import httplib2
+from cachetools import TTLCache
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+from rate_limit import AdaptiveTokenBucket
+from metrics import GMAIL_REQUEST_SECONDS
+
+# Point at a local fake server (see fake_gmail.py) to run syncs offline.
+GMAIL_API_ENDPOINT = os.getenv("GMAIL_API_ENDPOINT", "https://gmail.googleapis.com/")
+PROFILE_TTL = 3600
+# Gmail's per-user quota is 250 units/second. Every account gets its own
+# adaptive bucket, so one large mailbox cannot starve the others.
+USER_QUOTA_UNITS_PER_SECOND = float(os.getenv("GMAIL_USER_QUOTA", "250"))
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "gmail.users.getProfile": 1,
+    "gmail.users.watch": 100,
+    "gmail.users.history.list": 2,
+    "gmail.users.messages.list": 5,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.send": 100,
+    "gmail.users.messages.attachments.get": 5,
+}
+DEFAULT_QUOTA_UNITS = 5
+
+MAX_RETRIES = 6
+MAX_BACKOFF = 64
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+# Parsed once per process, on the first Gmail call, instead of on every
+# build(). rootUrl is rewritten too, since media uploads are addressed from
+# it rather than api_endpoint.
+_discovery_doc = None
+_discovery_lock = threading.Lock()
+
+# httplib2.Http is not thread-safe, so every thread keeps its own service
+# (and connection pool) per credential.
+_local = threading.local()
+
+_profile_cache = TTLCache(maxsize=1024, ttl=PROFILE_TTL)
+_profile_lock = threading.Lock()
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+# Per-method counters, see quota_stats()
+_stats = defaultdict(lambda: {"calls": 0, "units": 0, "retries": 0, "rate_limited": 0, "errors": 0})
+_stats_lock = threading.Lock()
+
+
+def _discovery():
+    global _discovery_doc
+    with _discovery_lock:
+        if _discovery_doc is None:
+            doc = json.loads(get_static_doc("gmail", "v1"))
+            doc["rootUrl"] = GMAIL_API_ENDPOINT
+            _discovery_doc = doc
+        return _discovery_doc
+
+
+def _creds_key(creds):
+    return getattr(creds, "refresh_token", None) or getattr(creds, "token", None)
+
+
+def _bucket_for(key):
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = AdaptiveTokenBucket(USER_QUOTA_UNITS_PER_SECOND)
+        return bucket
+
+
+class _AccountHttp(AuthorizedHttp):
+    """AuthorizedHttp that carries its account's quota bucket for execute()."""
+
+    def __init__(self, credentials, bucket, **kwargs):
+        super().__init__(credentials, **kwargs)
+        self.bucket = bucket
+
+
+def get_gmail_service(creds):
+    """Return this thread's cached Gmail service for creds, building it on first use."""
+    services = getattr(_local, "services", None)
+    if services is None:
+        services = _local.services = {}
+
+    key = _creds_key(creds)
+    cached = services.get(key)
+    if cached is None:
+        http = _AccountHttp(creds, _bucket_for(key), http=build_http())
+        service = build_from_document(
+            _discovery(),
+            http=http,
+            client_options={"api_endpoint": GMAIL_API_ENDPOINT},
+        )
+        services[key] = (service, http)
+        return service
+
+    service, http = cached
+    if http.credentials is not creds:
+        # Same account, refreshed credentials object: keep the connection.
+        http.credentials = creds
+    return service
+
+
+def get_email_address(creds):
+    """users.getProfile emailAddress, cached for PROFILE_TTL seconds."""
+    key = _creds_key(creds)
+    with _profile_lock:
+        email = _profile_cache.get(key)
+    if email:
+        return email
+
+    profile = execute(get_gmail_service(creds).users().getProfile(userId="me"))
+    with _profile_lock:
+        _profile_cache[key] = profile["emailAddress"]
+    return profile["emailAddress"]
+
+
+def record_stats(method, **increments):
+    with _stats_lock:
+        for name, value in increments.items():
+            _stats[method][name] += value
+
+
+def is_rate_limited(error):
+    if error.resp.status == 429:
+        return True
+    if error.resp.status != 403:
+        return False
+    try:
+        errors = json.loads(error.content).get("error", {}).get("errors", [])
+    except Exception:
+        return False
+    return any(e.get("reason") in RATE_LIMIT_REASONS for e in errors)
+
+
+def is_retryable(error):
+    return error.resp.status in RETRYABLE_STATUSES or is_rate_limited(error)
+
+
+def backoff_delay(attempt, error=None):
+    """Exponential backoff with full jitter, never shorter than Retry-After."""
+    delay = random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+    retry_after = error.resp.get("retry-after") if error is not None else None
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+
+def quota_units(method):
+    return QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS)
+
+
+def execute(request, bucket=None, units=None, method=None, idempotent=True):
+    """
+    Execute a Gmail API request (or batch) under the account's quota bucket.
+    Throttling and 5xx errors are retried with backoff; the bucket slows
+    down on rate-limit errors and speeds back up on success. Non-idempotent
+    calls (send) are only retried when the server rejected them for quota.
+    """
+    method = method or getattr(request, "methodId", "unknown")
+    units = units if units is not None else quota_units(method)
+    bucket = bucket or request.http.bucket
+
+    for attempt in range(MAX_RETRIES + 1):
+        bucket.acquire(units)
+        record_stats(method, calls=1, units=units)
+        error = None
+        outcome = "ok"
+        started = time.perf_counter()
+        try:
+            response = request.execute()
+        except HttpError as e:
+            outcome = str(e.resp.status)
+            if is_rate_limited(e):
+                bucket.throttle()
+                record_stats(method, rate_limited=1)
+            retryable = is_retryable(e) if idempotent else is_rate_limited(e)
+            if not retryable or attempt == MAX_RETRIES:
+                record_stats(method, errors=1)
+                raise
+            error = e
+        except (TimeoutError, ConnectionError, httplib2.HttpLib2Error):
+            outcome = "network_error"
+            if not idempotent or attempt == MAX_RETRIES:
+                record_stats(method, errors=1)
+                raise
+        else:
+            bucket.recover()
+            return response
+        finally:
+            GMAIL_REQUEST_SECONDS.observe(time.perf_counter() - started, method=method, outcome=outcome)
+
+        record_stats(method, retries=1)
+        time.sleep(backoff_delay(attempt, error))
+
+
+def quota_stats():
+    """Per-method call counters and each account bucket's current rate."""
+    with _stats_lock:
+        methods = {m: dict(v) for m, v in _stats.items()}
+    with _buckets_lock:
+        rates = [round(b.rate, 1) for b in _buckets.values()]
+    return {"methods": methods, "account_rates": rates, "max_rate": USER_QUOTA_UNITS_PER_SECOND}
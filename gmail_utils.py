@@ -1,13 +1,65 @@
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from models import Email, SyncState
+from googleapiclient.http import BatchHttpRequest
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from models import Account, SyncState, ResyncCheckpoint
 from database import SessionLocal
-import os, re, base64, json
-from datetime import datetime
+from ingestion import (
+    known_message_ids, email_ids_by_message, bulk_insert_emails,
+    delete_emails, set_starred, add_labels, remove_labels, store_labels,
+)
+from gmail_service import (
+    GMAIL_API_ENDPOINT, get_gmail_service, get_email_address,
+    execute, quota_units, is_retryable, is_rate_limited, backoff_delay, record_stats,
+)
+from rate_limit import TokenBucket
+from attachments import download_attachments, store_attachments
+from cache import invalidate_messages
+from bodies import store_bodies
+from changes import record_changes
+from threads import add_to_threads, assign_threads, refresh_threads, thread_ids_of
+from metrics import EMAILS_INGESTED
+from logs import get_logger
+from concurrent.futures import ThreadPoolExecutor
+import os, re, time
+from datetime import datetime, timedelta
 from email.utils import parsedate_to_datetime
 
-SAVE_ATTACHMENTS_FOLDER = "attachments"
-os.makedirs(SAVE_ATTACHMENTS_FOLDER, exist_ok=True)
+# Download attachments and/or store the decoded text/HTML bodies of new
+# messages. Both need format="full" fetches, which cost the same quota as
+# metadata but return the MIME structure.
+SYNC_ATTACHMENTS = os.getenv("SYNC_ATTACHMENTS", "0") == "1"
+SYNC_BODIES = os.getenv("SYNC_BODIES", "0") == "1"
+MESSAGE_FORMAT = "full" if SYNC_ATTACHMENTS or SYNC_BODIES else "metadata"
+
+# Gmail accepts up to 100 calls per batch, but recommends staying at or
+# below 50 to avoid per-user concurrency limits.
+BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+BATCH_MAX_RETRIES = 5
+RATE_LIMITED_SHARE = 0.1
+METADATA_HEADERS = ["Subject", "From", "To", "Date"]
+
+# The mirror holds the messages carrying MIRROR_LABEL, minus anything that is
+# also in an EXCLUDED_LABELS label. Every label of a stored message is kept
+# in email_labels; is_starred mirrors STARRED for the existing indexes.
+MIRROR_LABEL = "INBOX"
+EXCLUDED_LABELS = {"TRASH", "SPAM"}
+STARRED_LABEL = "STARRED"
+
+# Full resync: list pages are split into batches fetched by RESYNC_WORKERS
+# threads, all sharing one messages.get budget per process.
+RESYNC_PAGE_SIZE = 500
+RESYNC_WORKERS = int(os.getenv("RESYNC_WORKERS", "4"))
+RESYNC_GETS_PER_SECOND = float(os.getenv("RESYNC_GETS_PER_SECOND", "100"))
+_resync_budget = TokenBucket(RESYNC_GETS_PER_SECOND)
+# A running resync re-stamps its checkpoint's locked_at with every page; one
+# not stamped for this long belongs to a dead process and can be taken over.
+RESYNC_LEASE = timedelta(minutes=10)
+log = get_logger("gmail_utils")
+
+
+class ResyncInProgress(Exception):
+    """Another thread or process holds the account's resync checkpoint."""
 
 
 def clean(text):
@@ -24,86 +76,261 @@ def _parse_date(date_str: str):
             return datetime.utcnow()
 
 
-def _get_or_create_sync_state(db, service):
-    profile = service.users().getProfile(userId="me").execute()
-    user_email = profile["emailAddress"]
+def _email_row(msg_data, account_id):
+    headers = msg_data.get("payload", {}).get("headers", [])
+    subject = next((h["value"] for h in headers if h["name"] == "Subject"), "") or ""
+    sender = next((h["value"] for h in headers if h["name"] == "From"), "") or ""
+    to_email = next((h["value"] for h in headers if h["name"] == "To"), "") or ""
+    date_str = next((h["value"] for h in headers if h["name"] == "Date"), "") or ""
+    snippet = msg_data.get("snippet", "") or ""
+    parsed_date = _parse_date(date_str) if date_str else datetime.utcnow()
+    label_ids = set(msg_data.get("labelIds", []))
+
+    return dict(
+        account_id=account_id,
+        subject=subject,
+        from_email=sender,
+        to_email=to_email,
+        date=parsed_date,
+        message_id=msg_data.get("id"),
+        thread_id=msg_data.get("threadId"),
+        body=snippet,
+        is_starred=1 if STARRED_LABEL in label_ids else 0,
+    )
+
+
+def batch_get_messages(service, message_ids, batch_size=BATCH_SIZE):
+    """
+    Fetch metadata (or full messages, see SYNC_ATTACHMENTS/SYNC_BODIES) for many
+    messages using Gmail batch HTTP requests.
+    Items that fail with 429/5xx are retried with exponential backoff;
+    returns {message_id: message_resource} for every message that succeeded.
+    """
+    results = {}
+    pending = list(dict.fromkeys(message_ids))
+    batch_uri = GMAIL_API_ENDPOINT.rstrip("/") + "/batch/gmail/v1"
+    method = "gmail.users.messages.get"
+
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        retry = []
+        retry_errors = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            elif isinstance(exception, HttpError) and is_retryable(exception):
+                retry.append(request_id)
+                retry_errors.append(exception)
+            elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                # Message was deleted between list() and get()
+                pass
+            else:
+                raise exception
+
+        for i in range(0, len(pending), batch_size):
+            batch = BatchHttpRequest(callback=callback, batch_uri=batch_uri)
+            requests = [
+                service.users().messages().get(
+                    userId="me",
+                    id=msg_id,
+                    format=MESSAGE_FORMAT,
+                    metadataHeaders=METADATA_HEADERS,
+                )
+                for msg_id in pending[i:i + batch_size]
+            ]
+            for msg_id, request in zip(pending[i:i + batch_size], requests):
+                batch.add(request, request_id=msg_id)
+            bucket = requests[0].http.bucket
+            execute(batch, bucket=bucket, units=quota_units(method) * len(requests), method=method)
+
+        if not retry:
+            break
+        if attempt == BATCH_MAX_RETRIES:
+            raise RuntimeError(f"Gave up fetching {len(retry)} messages after {BATCH_MAX_RETRIES} retries")
+
+        # A few throttled items per batch are normal; slow down only when
+        # a sizeable share of the calls were rejected for quota.
+        rate_limited = sum(1 for e in retry_errors if is_rate_limited(e))
+        record_stats(method, retries=len(retry), rate_limited=rate_limited)
+        if rate_limited > RATE_LIMITED_SHARE * len(pending):
+            bucket.throttle()
+        time.sleep(max(backoff_delay(attempt, e) for e in retry_errors))
+        pending = retry
+
+    return results
+
+
+def _get_or_create_account(db, creds):
+    user_email = get_email_address(creds)
+
+    account = db.query(Account).filter_by(email=user_email).first()
+    if not account:
+        account = Account(email=user_email)
+        db.add(account)
+        try:
+            db.commit()
+        except IntegrityError:
+            # Lost a race with a concurrent sync creating the same account
+            db.rollback()
+            return db.query(Account).filter_by(email=user_email).one()
+        db.refresh(account)
+    return account
+
+
+def _get_or_create_sync_state(db, creds):
+    user_email = get_email_address(creds)
 
     state = db.query(SyncState).filter_by(user_email=user_email).first()
     if not state:
         state = SyncState(user_email=user_email, last_history_id=None)
         db.add(state)
-        db.commit()
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            return db.query(SyncState).filter_by(user_email=user_email).one()
         db.refresh(state)
     return state
 
 
-def fetch_and_store_emails(creds):
-    service = build("gmail", "v1", credentials=creds)
+def _fetch_chunk(creds, message_ids, batch_size):
+    # Runs in a resync worker thread, which has its own cached service.
+    _resync_budget.acquire(len(message_ids))
+    return batch_get_messages(get_gmail_service(creds), message_ids, batch_size)
+
+
+def _claim_resync(db, account_id):
+    """
+    Take the account's resync checkpoint, creating it on the first resync.
+    The conditional UPDATE matches only a checkpoint nobody holds or whose
+    lease ran out, so of concurrent resyncs of one account, in any process,
+    exactly one gets it; the others raise ResyncInProgress.
+    """
+    if db.query(ResyncCheckpoint.id).filter_by(account_id=account_id).first() is None:
+        db.add(ResyncCheckpoint(account_id=account_id))
+        try:
+            db.commit()
+        except IntegrityError:
+            # Created by a concurrent resync; the claim below settles it
+            db.rollback()
+
+    now = datetime.utcnow()
+    claimed = (
+        db.query(ResyncCheckpoint)
+        .filter(
+            ResyncCheckpoint.account_id == account_id,
+            or_(ResyncCheckpoint.locked_at.is_(None), ResyncCheckpoint.locked_at < now - RESYNC_LEASE),
+        )
+        .update({"locked_at": now}, synchronize_session=False)
+    )
+    db.commit()
+    if not claimed:
+        raise ResyncInProgress(f"A resync of account {account_id} is already running")
+    return db.query(ResyncCheckpoint).filter_by(account_id=account_id).one()
+
+
+def fetch_and_store_emails(creds, batch_size=BATCH_SIZE, workers=RESYNC_WORKERS):
+    """
+    Full, resumable resync of the account's primary inbox.
+    Progress is checkpointed per page in resync_checkpoints; an interrupted
+    run picks up from the stored page token. Returns the number of new emails.
+    """
+    service = get_gmail_service(creds)
     db = SessionLocal()
 
     try:
+        account_id = _get_or_create_account(db, creds).id
+        checkpoint = _claim_resync(db, account_id)
         total_new = 0
-        page_token = None
-        while True:
-            result = service.users().messages().list(
-                userId="me",
-                maxResults=100,
-                pageToken=page_token,
-                labelIds=["INBOX"],
-                q="category:primary",
-            ).execute()
-
-            messages = result.get("messages", [])
-            page_token = result.get("nextPageToken")
-
-            for msg in messages:
-                msg_data = service.users().messages().get(
-                    userId="me",
-                    id=msg["id"],
-                    format="metadata",
-                    metadataHeaders=["Subject", "From", "To", "Date"],
-                ).execute()
-
-                headers = msg_data.get("payload", {}).get("headers", [])
-                subject = next((h["value"] for h in headers if h["name"] == "Subject"), "") or ""
-                sender = next((h["value"] for h in headers if h["name"] == "From"), "") or ""
-                to_email = next((h["value"] for h in headers if h["name"] == "To"), "") or ""
-                date_str = next((h["value"] for h in headers if h["name"] == "Date"), "") or ""
-                snippet = msg_data.get("snippet", "") or ""
-                parsed_date = _parse_date(date_str) if date_str else datetime.utcnow()
-                message_id = msg_data.get("id")
-                label_ids = set(msg_data.get("labelIds", []))
-
-                if "TRASH" in label_ids or "SPAM" in label_ids:
-                    continue
-
-                is_starred = 1 if "STARRED" in label_ids else 0
-
-                if db.query(Email).filter(Email.message_id == message_id).first():
-                    continue
-
-                db_email = Email(
-                    subject=subject,
-                    from_email=sender,
-                    to_email=to_email,
-                    date=parsed_date,
-                    message_id=message_id,
-                    body=snippet,
-                    is_starred=is_starred,
-                )
-                db.add(db_email)
-                total_new += 1
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # A run that started but never finished (crashed or failed) is continued
+                if checkpoint.start_history_id and checkpoint.finished_at is None:
+                    log.info("resuming resync", extra={
+                        "account_id": account_id, "page": checkpoint.pages, "processed": checkpoint.processed,
+                    })
+                else:
+                    # History during the resync is replayed from this id afterwards.
+                    profile = execute(service.users().getProfile(userId="me"))
+                    checkpoint.page_token = None
+                    checkpoint.start_history_id = str(profile.get("historyId"))
+                    checkpoint.estimated_total = profile.get("messagesTotal")
+                    checkpoint.pages = checkpoint.processed = checkpoint.inserted = 0
+                    checkpoint.started_at = datetime.utcnow()
+                    checkpoint.finished_at = None
+                checkpoint.status = "running"
+                checkpoint.error = None
+                db.commit()
 
+                while True:
+                    result = execute(service.users().messages().list(
+                        userId="me",
+                        maxResults=RESYNC_PAGE_SIZE,
+                        pageToken=checkpoint.page_token,
+                        labelIds=[MIRROR_LABEL],
+                        q="category:primary",
+                    ))
+
+                    messages = result.get("messages", [])
+                    page_ids = [m["id"] for m in messages]
+                    known = known_message_ids(db, account_id, page_ids)
+                    to_fetch = [m for m in page_ids if m not in known]
+
+                    chunks = [to_fetch[i:i + batch_size] for i in range(0, len(to_fetch), batch_size)]
+                    fetched = {}
+                    for part in pool.map(lambda c: _fetch_chunk(creds, c, batch_size), chunks):
+                        fetched.update(part)
+
+                    rows = []
+                    for msg_data in fetched.values():
+                        if EXCLUDED_LABELS & set(msg_data.get("labelIds", [])):
+                            continue
+                        rows.append(_email_row(msg_data, account_id))
+                    if SYNC_ATTACHMENTS:
+                        downloaded = download_attachments(creds, {r["message_id"]: fetched[r["message_id"]] for r in rows})
+
+                    # All writes happen after the fetch and downloads, keeping the transaction short.
+                    # Emails stored before threads existed get their threadId from the listing
+                    assign_threads(db, account_id, {m["id"]: m["threadId"] for m in messages if m["id"] in known and "threadId" in m})
+                    inserted_ids = bulk_insert_emails(db, rows)
+                    new_ids = set(inserted_ids)
+                    add_to_threads(db, account_id, [r for r in rows if r["message_id"] in new_ids])
+                    store_labels(db, account_id, {m: fetched[m] for m in inserted_ids})
+                    if SYNC_ATTACHMENTS:
+                        store_attachments(db, account_id, {m: downloaded[m] for m in inserted_ids if m in downloaded})
+                    if SYNC_BODIES:
+                        store_bodies(db, account_id, {m: fetched[m] for m in inserted_ids})
+                    record_changes(db, account_id, "insert", email_ids_by_message(db, account_id, inserted_ids))
+                    inserted = len(inserted_ids)
+                    total_new += inserted
+
+                    # Checkpoint commits together with the page's rows, and renews the lease
+                    checkpoint.page_token = result.get("nextPageToken")
+                    checkpoint.pages += 1
+                    checkpoint.processed += len(page_ids)
+                    checkpoint.inserted += inserted
+                    checkpoint.locked_at = datetime.utcnow()
+                    db.commit()
+                    EMAILS_INGESTED.inc(inserted, source="resync")
+                    invalidate_messages(account_id, inserted_ids)
+
+                    if not checkpoint.page_token:
+                        break
+
+            state = _get_or_create_sync_state(db, creds)
+            state.last_history_id = checkpoint.start_history_id or state.last_history_id
+            checkpoint.status = "done"
+            checkpoint.finished_at = datetime.utcnow()
+            checkpoint.locked_at = None
             db.commit()
-
-            if not page_token:
-                break
-
-        # Update last_history_id after full fetch
-        state = _get_or_create_sync_state(db, service)
-        profile = service.users().getProfile(userId="me").execute()
-        state.last_history_id = profile.get("historyId", state.last_history_id)
-        db.commit()
+        except Exception as e:
+            # Not resumed at startup any more; the next resync of the account continues it
+            db.rollback()
+            checkpoint.status = "failed"
+            checkpoint.error = str(e)
+            checkpoint.locked_at = None
+            db.commit()
+            raise
 
         return total_new
 
@@ -111,140 +338,173 @@ def fetch_and_store_emails(creds):
         db.close()
 
 
-def sync_history(creds, start_history_id: str):
+HISTORY_KEYS = ("messagesAdded", "labelsAdded", "labelsRemoved", "messagesDeleted")
+
+
+def compact_history(records):
+    """
+    Fold a page of history records into one net change per message id:
+    {message_id: {"new", "deleted", "added", "removed", "labels"}}.
+
+    "added" and "removed" are the label changes left once the page's
+    add/remove pairs cancel out, "labels" is the message's latest label set
+    when Gmail sent one with the record (else None), "new" and "deleted" say
+    whether the page added or deleted the message.
+    """
+    changes = {}
+    for record in records:
+        for key in HISTORY_KEYS:
+            for item in record.get(key, []):
+                message = item["message"]
+                change = changes.get(message["id"])
+                if change is None:
+                    change = changes[message["id"]] = {
+                        "new": False, "deleted": False, "added": set(), "removed": set(), "labels": None,
+                    }
+
+                if key == "messagesAdded":
+                    change["new"] = True
+                elif key == "messagesDeleted":
+                    change["deleted"] = True
+                else:
+                    # An add cancels an earlier remove of the same label and vice versa
+                    undo, do = ("removed", "added") if key == "labelsAdded" else ("added", "removed")
+                    for label in item.get("labelIds", []):
+                        if label in change[undo]:
+                            change[undo].discard(label)
+                        else:
+                            change[do].add(label)
+                        if change["labels"] is not None:
+                            if do == "added":
+                                change["labels"].add(label)
+                            else:
+                                change["labels"].discard(label)
+
+                if "labelIds" in message:
+                    change["labels"] = set(message["labelIds"])
+    return changes
+
+
+def _in_mirror(change):
+    """Whether a compacted message belongs in the mirror at the end of the page."""
+    if change["deleted"]:
+        return False
+    labels = change["labels"]
+    if labels is None:
+        return MIRROR_LABEL not in change["removed"] and not EXCLUDED_LABELS & change["added"]
+    return MIRROR_LABEL in labels and not EXCLUDED_LABELS & labels
+
+
+def sync_history(creds, start_history_id: str, batch_size=BATCH_SIZE):
     """
     Incremental Gmail sync with history.
     Returns the latest historyId or triggers full resync if expired.
     """
-    service = build("gmail", "v1", credentials=creds)
+    service = get_gmail_service(creds)
     db = SessionLocal()
 
     latest_history_id = start_history_id
     try:
+        account_id = _get_or_create_account(db, creds).id
         page_token = None
         while True:
-            history = service.users().history().list(
+            history = execute(service.users().history().list(
                 userId="me",
                 startHistoryId=start_history_id,
                 historyTypes=["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"],
                 pageToken=page_token,
-            ).execute()
+            ))
 
             if "history" not in history:
-                print("⚠️ No history details returned. Performing full fetch.")
+                log.warning("no history returned, running full resync", extra={"account_id": account_id})
                 fetch_and_store_emails(creds)
-                profile = service.users().getProfile(userId="me").execute()
-                return str(profile.get("historyId"))
+                db.expire_all()
+                return _get_or_create_sync_state(db, creds).last_history_id
 
             if "historyId" in history:
                 latest_history_id = str(history["historyId"])
 
                 # persist progressively
-                state = _get_or_create_sync_state(db, service)
+                state = _get_or_create_sync_state(db, creds)
                 state.last_history_id = latest_history_id
                 db.commit()
 
-            for change in history.get("history", []):
-                # Deleted messages
-                for item in change.get("messagesDeleted", []):
-                    msg_id = item["message"]["id"]
-                    db.query(Email).filter(Email.message_id == msg_id).delete()
-
-                # Labels added
-                for item in change.get("labelsAdded", []):
-                    msg_id = item["message"]["id"]
-                    labels = set(item.get("labelIds", []))
-
-                    if "STARRED" in labels:
-                        email = db.query(Email).filter(Email.message_id == msg_id).first()
-                        if email:
-                            email.is_starred = 1
-
-                    if "INBOX" in labels:
-                        if not db.query(Email).filter(Email.message_id == msg_id).first():
-                            msg_data = service.users().messages().get(
-                                userId="me",
-                                id=msg_id,
-                                format="metadata",
-                                metadataHeaders=["Subject", "From", "To", "Date"],
-                            ).execute()
-
-                            headers = msg_data.get("payload", {}).get("headers", [])
-                            subject = next((h["value"] for h in headers if h["name"] == "Subject"), "") or ""
-                            sender = next((h["value"] for h in headers if h["name"] == "From"), "") or ""
-                            to_email = next((h["value"] for h in headers if h["name"] == "To"), "") or ""
-                            date_str = next((h["value"] for h in headers if h["name"] == "Date"), "") or ""
-                            snippet = msg_data.get("snippet", "") or ""
-                            parsed_date = _parse_date(date_str) if date_str else datetime.utcnow()
-                            label_ids = set(msg_data.get("labelIds", []))
-                            is_starred = 1 if "STARRED" in label_ids else 0
-
-                            db_email = Email(
-                                subject=subject,
-                                from_email=sender,
-                                to_email=to_email,
-                                date=parsed_date,
-                                message_id=msg_id,
-                                body=snippet,
-                                is_starred=is_starred,
-                            )
-                            db.add(db_email)
-                            print(f"📩 Restored to INBOX: {subject} from {sender}")
-
-                # Labels removed
-                for item in change.get("labelsRemoved", []):
-                    msg_id = item["message"]["id"]
-                    labels = set(item.get("labelIds", []))
-
-                    if "STARRED" in labels:
-                        email = db.query(Email).filter(Email.message_id == msg_id).first()
-                        if email:
-                            email.is_starred = 0
-
-                    if "INBOX" in labels:
-                        db.query(Email).filter(Email.message_id == msg_id).delete()
-
-                # New messages
-                for item in change.get("messagesAdded", []):
-                    msg_id = item["message"]["id"]
-
-                    if db.query(Email).filter(Email.message_id == msg_id).first():
-                        continue
-
-                    msg_data = service.users().messages().get(
-                        userId="me",
-                        id=msg_id,
-                        format="metadata",
-                        metadataHeaders=["Subject", "From", "To", "Date"],
-                    ).execute()
-
-                    headers = msg_data.get("payload", {}).get("headers", [])
-                    subject = next((h["value"] for h in headers if h["name"] == "Subject"), "") or ""
-                    sender = next((h["value"] for h in headers if h["name"] == "From"), "") or ""
-                    to_email = next((h["value"] for h in headers if h["name"] == "To"), "") or ""
-                    date_str = next((h["value"] for h in headers if h["name"] == "Date"), "") or ""
-                    snippet = msg_data.get("snippet", "") or ""
-                    parsed_date = _parse_date(date_str) if date_str else datetime.utcnow()
-                    label_ids = set(msg_data.get("labelIds", []))
-
-                    if "TRASH" in label_ids or "SPAM" in label_ids:
-                        continue
-
-                    is_starred = 1 if "STARRED" in label_ids else 0
-
-                    db_email = Email(
-                        subject=subject,
-                        from_email=sender,
-                        to_email=to_email,
-                        date=parsed_date,
-                        message_id=msg_id,
-                        body=snippet,
-                        is_starred=is_starred,
-                    )
-                    db.add(db_email)
-                    print(f"📥 New inbox message: {subject} from {sender}")
+            changes = compact_history(history.get("history", []))
+            # {message_id: email id} of the page's messages we already store
+            known = email_ids_by_message(db, account_id, changes)
+
+            # Messages to insert once the page is read, fetched in one batch:
+            # {message_id: "new" | "restored"}
+            pending = {}
+            # Stored messages this page deletes or relabels: {message_id: email id}
+            deleted, updated = {}, {}
+            starred, unstarred, labels_added, labels_removed = [], [], [], []
+
+            for msg_id, change in changes.items():
+                email_id = known.get(msg_id)
+                if email_id is None:
+                    # Not stored yet, so its headers have to be fetched
+                    if _in_mirror(change) and (change["new"] or MIRROR_LABEL in change["added"]):
+                        pending[msg_id] = "new" if change["new"] else "restored"
+                    continue
+
+                if not _in_mirror(change):
+                    deleted[msg_id] = email_id
+                    continue
+                # Labels are applied from the delta, no refetch
+                labels_added.extend((email_id, label) for label in change["added"])
+                labels_removed.extend((email_id, label) for label in change["removed"])
+                if STARRED_LABEL in change["added"]:
+                    starred.append(email_id)
+                if STARRED_LABEL in change["removed"]:
+                    unstarred.append(email_id)
+                if change["added"] or change["removed"]:
+                    updated[msg_id] = email_id
+
+            fetched = batch_get_messages(service, list(pending), batch_size)
+
+            rows = []
+            for msg_id, kind in pending.items():
+                msg_data = fetched.get(msg_id)
+                if not msg_data:
+                    continue
+
+                label_ids = set(msg_data.get("labelIds", []))
+                if MIRROR_LABEL not in label_ids or EXCLUDED_LABELS & label_ids:
+                    continue
 
+                row = _email_row(msg_data, account_id)
+                rows.append(row)
+                log.info("inbox message " + kind, extra={
+                    "account_id": account_id, "message_id": msg_id, "from_email": row["from_email"],
+                })
+
+            if SYNC_ATTACHMENTS:
+                downloaded = download_attachments(creds, {r["message_id"]: fetched[r["message_id"]] for r in rows})
+
+            # All writes happen after the fetch and downloads, keeping the transaction short
+            touched_threads = thread_ids_of(db, [*deleted.values(), *starred, *unstarred])
+            delete_emails(db, deleted.values())
+            add_labels(db, labels_added)
+            remove_labels(db, labels_removed)
+            set_starred(db, starred, 1)
+            set_starred(db, unstarred, 0)
+
+            inserted_ids = bulk_insert_emails(db, rows)
+            new_ids = set(inserted_ids)
+            add_to_threads(db, account_id, [r for r in rows if r["message_id"] in new_ids])
+            refresh_threads(db, account_id, touched_threads)
+            store_labels(db, account_id, {m: fetched[m] for m in inserted_ids})
+            if SYNC_ATTACHMENTS:
+                store_attachments(db, account_id, {m: downloaded[m] for m in inserted_ids if m in downloaded})
+            if SYNC_BODIES:
+                store_bodies(db, account_id, {m: fetched[m] for m in inserted_ids})
+            record_changes(db, account_id, "delete", deleted)
+            record_changes(db, account_id, "update", updated)
+            record_changes(db, account_id, "insert", email_ids_by_message(db, account_id, inserted_ids))
             db.commit()
+            EMAILS_INGESTED.inc(len(inserted_ids), source="history")
+            invalidate_messages(account_id, set(deleted).union(updated, inserted_ids))
 
             page_token = history.get("nextPageToken")
             if not page_token:
@@ -254,10 +514,10 @@ def sync_history(creds, start_history_id: str):
 
     except HttpError as e:
         if e.resp.status == 404:
-            print("⚠️ History expired. Doing full resync.")
+            log.warning("history expired, running full resync", extra={"start_history_id": start_history_id})
             fetch_and_store_emails(creds)
-            profile = service.users().getProfile(userId="me").execute()
-            return str(profile.get("historyId"))
+            db.expire_all()
+            return _get_or_create_sync_state(db, creds).last_history_id
         else:
             raise
     finally:
@@ -0,0 +1,117 @@
+from sqlalchemy import insert, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from models import Email, EmailLabel
+
+
+def known_message_ids(db, account_id, message_ids):
+    """Return the subset of message_ids already stored for the account, using a single IN query."""
+    message_ids = list(set(message_ids))
+    if not message_ids:
+        return set()
+    rows = (
+        db.query(Email.message_id)
+        .filter(Email.account_id == account_id, Email.message_id.in_(message_ids))
+        .all()
+    )
+    return {row.message_id for row in rows}
+
+
+def email_ids_by_message(db, account_id, message_ids):
+    """Like known_message_ids, but returns {message_id: email id}."""
+    message_ids = list(set(message_ids))
+    if not message_ids:
+        return {}
+    return dict(
+        db.query(Email.message_id, Email.id)
+        .filter(Email.account_id == account_id, Email.message_id.in_(message_ids))
+        .all()
+    )
+
+
+def bulk_insert_emails(db, rows):
+    """
+    Insert email rows (dicts of Email columns, all for the same account) in one
+    statement, skipping any message_id that is already stored for that account.
+    Returns the list of inserted message_ids.
+    """
+    if not rows:
+        return []
+
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(Email).values(rows).on_conflict_do_nothing(
+            index_elements=[Email.account_id, Email.message_id]
+        )
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(Email).values(rows).on_conflict_do_nothing(
+            index_elements=[Email.account_id, Email.message_id]
+        )
+    else:
+        known = known_message_ids(db, rows[0]["account_id"], [r["message_id"] for r in rows])
+        rows = [r for r in rows if r["message_id"] not in known]
+        if not rows:
+            return []
+        stmt = insert(Email).values(rows)
+        db.execute(stmt)
+        return [r["message_id"] for r in rows]
+
+    result = db.execute(stmt.returning(Email.message_id))
+    return [row.message_id for row in result]
+
+
+def delete_emails(db, email_ids):
+    """Delete emails by id in one statement; labels, bodies and attachments cascade."""
+    email_ids = list(set(email_ids))
+    if email_ids:
+        db.query(Email).filter(Email.id.in_(email_ids)).delete(synchronize_session=False)
+
+
+def set_starred(db, email_ids, value):
+    email_ids = list(set(email_ids))
+    if email_ids:
+        db.query(Email).filter(Email.id.in_(email_ids)).update(
+            {"is_starred": value}, synchronize_session=False
+        )
+
+
+def add_labels(db, pairs):
+    """Insert (email_id, label_id) pairs, ignoring ones already present."""
+    rows = [{"email_id": e, "label_id": l} for e, l in set(pairs)]
+    if not rows:
+        return
+
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(EmailLabel).values(rows).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(EmailLabel).values(rows).on_conflict_do_nothing()
+    else:
+        existing = set(
+            db.query(EmailLabel.email_id, EmailLabel.label_id)
+            .filter(tuple_(EmailLabel.email_id, EmailLabel.label_id).in_([(r["email_id"], r["label_id"]) for r in rows]))
+            .all()
+        )
+        rows = [r for r in rows if (r["email_id"], r["label_id"]) not in existing]
+        if not rows:
+            return
+        stmt = insert(EmailLabel).values(rows)
+    db.execute(stmt)
+
+
+def remove_labels(db, pairs):
+    """Delete (email_id, label_id) pairs."""
+    pairs = list(set(pairs))
+    if pairs:
+        db.query(EmailLabel).filter(
+            tuple_(EmailLabel.email_id, EmailLabel.label_id).in_(pairs)
+        ).delete(synchronize_session=False)
+
+
+def store_labels(db, account_id, messages):
+    """Record the labelIds of freshly inserted messages ({message_id: resource})."""
+    email_ids = email_ids_by_message(db, account_id, messages)
+    add_labels(db, [
+        (email_ids[msg_id], label)
+        for msg_id, msg in messages.items() if msg_id in email_ids
+        for label in msg.get("labelIds", [])
+    ])
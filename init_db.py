@@ -0,0 +1,108 @@
+"""
+Create or upgrade the database schema. Run once per deployment, before
+starting the API or workers; it is idempotent, so re-running is safe:
+
+    python init_db.py
+"""
+from datetime import datetime
+from sqlalchemy import inspect, select, text
+from database import get_engine
+from models import Base, Account, Email, SyncState
+from attachments import ensure_attachment_columns
+from search import ensure_search_index
+from threads import ensure_thread_column
+from logs import get_logger
+
+log = get_logger("init_db")
+
+
+def _columns(engine, table):
+    return {c["name"] for c in inspect(engine).get_columns(table)}
+
+
+def ensure_updated_at_column(engine):
+    """Add emails.updated_at to databases created before the export (idempotent)."""
+    if "updated_at" in _columns(engine, "emails"):
+        return
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE emails ADD COLUMN updated_at TIMESTAMP"))
+        # Existing rows count as changed now, so the next incremental export includes them
+        conn.execute(Email.__table__.update().values(updated_at=datetime.utcnow()))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_emails_updated_at ON emails (updated_at)"))
+
+
+def ensure_resync_lock_column(engine):
+    """Add resync_checkpoints.locked_at to databases created before resyncs were claimed (idempotent)."""
+    if "locked_at" not in _columns(engine, "resync_checkpoints"):
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE resync_checkpoints ADD COLUMN locked_at TIMESTAMP"))
+
+
+def _backfill_account(conn):
+    # Single-account databases kept that account's address in sync_state
+    owners = conn.execute(select(SyncState.user_email).where(SyncState.user_email.is_not(None))).scalars().all()
+    if len(owners) != 1:
+        orphans = conn.execute(select(Email.id).where(Email.account_id.is_(None)).limit(1)).first()
+        if orphans:
+            log.warning("existing emails left without an account; a resync stores them again", extra={
+                "accounts": owners,
+            })
+        return
+    account_id = conn.execute(select(Account.id).where(Account.email == owners[0])).scalar()
+    if account_id is None:
+        account_id = conn.execute(Account.__table__.insert().values(
+            email=owners[0], created_at=datetime.utcnow(),
+        )).inserted_primary_key[0]
+    conn.execute(Email.__table__.update().where(Email.account_id.is_(None)).values(account_id=account_id))
+
+
+def ensure_account_columns(engine):
+    """
+    Upgrade single-account databases (idempotent): add sync_state.last_synced_at
+    and emails.account_id, make message ids unique per account rather than
+    globally, and assign the existing emails to the account that synced them.
+    """
+    if "last_synced_at" not in _columns(engine, "sync_state"):
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE sync_state ADD COLUMN last_synced_at TIMESTAMP"))
+    if "account_id" in _columns(engine, "emails"):
+        return
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE emails ADD COLUMN account_id INTEGER REFERENCES accounts (id)"))
+        # message_id had a globally unique index
+        conn.execute(text("DROP INDEX IF EXISTS ix_emails_message_id"))
+        conn.execute(text("CREATE INDEX ix_emails_message_id ON emails (message_id)"))
+        if engine.dialect.name == "sqlite":
+            # SQLite cannot add a constraint to an existing table; a unique index enforces the same
+            conn.execute(text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS uq_emails_account_message ON emails (account_id, message_id)"
+            ))
+        else:
+            conn.execute(text(
+                "ALTER TABLE emails ADD CONSTRAINT uq_emails_account_message UNIQUE (account_id, message_id)"
+            ))
+        _backfill_account(conn)
+
+
+def ensure_indexes(engine):
+    """Create the model's indexes on tables that create_all found already present (idempotent)."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def init_db(engine=None):
+    engine = engine or get_engine()
+    Base.metadata.create_all(bind=engine)
+    ensure_updated_at_column(engine)
+    ensure_attachment_columns(engine)
+    ensure_account_columns(engine)
+    ensure_resync_lock_column(engine)
+    ensure_search_index(engine)
+    ensure_thread_column(engine)
+    ensure_indexes(engine)
+
+
+if __name__ == "__main__":
+    init_db()
+    log.info("database schema is up to date")
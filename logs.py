@@ -0,0 +1,47 @@
+import os, json, uuid, logging, contextvars
+from datetime import datetime, timezone
+
+# JSON-lines logs. Every record carries the trace id of the request or job
+# that produced it; extra={...} fields are included as top-level keys.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+trace_id_var = contextvars.ContextVar("trace_id", default=None)
+
+_STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "trace_id": trace_id_var.get(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+_root = logging.getLogger("gmail_task")
+
+
+def get_logger(name):
+    if not _root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+        _root.addHandler(handler)
+        _root.setLevel(LOG_LEVEL)
+        _root.propagate = False
+    return _root.getChild(name)
+
+
+def new_trace_id(trace_id=None):
+    """Start a trace (a fresh id unless one is given) in the current context."""
+    trace_id = trace_id or uuid.uuid4().hex
+    trace_id_var.set(trace_id)
+    return trace_id
@@ -1,17 +1,103 @@
-from fastapi import FastAPI, HTTPException, Depends, Request, UploadFile, File, Form, status
-from sqlalchemy.orm import Session
-from auth import get_credentials, flow
-from gmail_utils import fetch_and_store_emails, sync_history, _get_or_create_sync_state
-from database import SessionLocal, engine
-from models import Base, Email, SyncState
-from schemas import EmailSchema
-from typing import List
-from send_gmail import send_email_with_gmail_api
-from googleapiclient.discovery import build
-import requests, os, json, base64
-
-Base.metadata.create_all(bind=engine)
-app = FastAPI()
+from fastapi import APIRouter, FastAPI, HTTPException, Depends, Request, UploadFile, File, Form, Query, Header, status
+from fastapi.responses import StreamingResponse, FileResponse, Response, PlainTextResponse
+from sqlalchemy import tuple_, select
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from auth import get_credentials, save_credentials, clear_credentials, resolve_account, list_accounts, get_flow
+from gmail_utils import ResyncInProgress, fetch_and_store_emails, _get_or_create_sync_state
+from database import SessionLocal, AsyncSessionLocal, dispose_engines
+from models import Account, Attachment, Email, EmailLabel, Thread, ResyncCheckpoint, OutboxMessage
+from schemas import (
+    EmailSchema, EmailBodySchema, EmailPageSchema, EmailSearchPageSchema, EmailChangePageSchema,
+    ThreadPageSchema, ThreadDetailSchema,
+    OutboxBulkIn, OutboxStatusSchema,
+)
+from typing import List, Optional
+from datetime import datetime, timezone
+from send_gmail import send_email_with_gmail_api, format_recipients, _header
+from sync_worker import enqueue_sync, start_workers, stop_workers
+import outbox
+from search import search_emails
+from bodies import load_body
+from changes import CHANGES_POLL_INTERVAL, CHANGES_MAX_WAIT, SSE_HEARTBEAT, is_expired, latest_seq, read_changes
+from cache import MemoryCache, get_cache, etag_for, listing_key, generation, email_key, cache_email, invalidate_all
+from gmail_service import get_gmail_service, get_email_address, execute, quota_stats
+from metrics import HTTP_REQUEST_SECONDS, render as render_metrics
+from logs import get_logger, new_trace_id
+import gmail_async
+from contextlib import asynccontextmanager
+import anyio, asyncio, os, json, base64, csv, io, time
+
+# Importing this module has no side effects: the schema is created by
+# init_db.py, and the engines, OAuth flow and Gmail clients on first use.
+router = APIRouter()
+log = get_logger("main")
+# Threads for the sync endpoints and run_in_threadpool calls (anyio defaults to 40)
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "100"))
+
+
+async def _follow_changes():
+    """
+    A MemoryCache only hears of the syncs run by its own process. Syncs other
+    API workers commit reach it through the change feed, polled like GET
+    /emails/changes does: any new seq drops every cached response.
+    """
+    first, seen = True, None
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                seq = await latest_seq(db)
+            if not first and seq != seen:
+                invalidate_all()
+            first, seen = False, seq
+        except Exception:
+            log.exception("change feed poll failed")
+        await asyncio.sleep(CHANGES_POLL_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    await run_in_threadpool(start_workers)
+    await run_in_threadpool(outbox.start_workers)
+    # A shared cache is invalidated by whichever process syncs
+    follower = asyncio.create_task(_follow_changes()) if isinstance(get_cache(), MemoryCache) else None
+    try:
+        yield
+    finally:
+        if follower is not None:
+            follower.cancel()
+        await run_in_threadpool(outbox.stop_workers)
+        await run_in_threadpool(stop_workers)
+        await gmail_async.aclose()
+        await dispose_engines()
+
+
+async def trace_and_time(request: Request, call_next):
+    """Give every request a trace id (X-Request-ID if sent) and time it per route."""
+    trace_id = new_trace_id(request.headers.get("x-request-id"))
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=route.path if route else "unmatched",
+            status=status_code,
+        )
+    response.headers["X-Request-ID"] = trace_id
+    return response
+
+
+@router.get("/metrics", tags=["Monitoring"])
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 
 def get_db():
     db = SessionLocal()
@@ -21,11 +107,16 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 # ---------------- AUTH ----------------
 
-@app.get("/login", tags=["Authentication"])
+@router.get("/login", tags=["Authentication"])
 def login_url():
-    authorization_url, _ = flow.authorization_url(
+    authorization_url, _ = get_flow().authorization_url(
         prompt="consent",
         access_type="offline",
         include_granted_scopes="true"
@@ -33,35 +124,41 @@ def login_url():
     return {"auth_url": authorization_url}
 
 
-@app.get("/oauth2callback", tags=["Authentication"])
+@router.get("/oauth2callback", tags=["Authentication"])
 def oauth2callback(request: Request):
     code = request.query_params.get("code")
     if not code:
         raise HTTPException(400, "Missing code in callback")
+    flow = get_flow()
     flow.fetch_token(code=code)
     creds = flow.credentials
-    with open("token.json", "w") as token:
-        token.write(creds.to_json())
-    return {"message": "Authentication successful! You can now call /fetch-emails."}
+    user_email = get_email_address(creds)
+    save_credentials(user_email, creds)
+    return {"message": f"Authentication successful for {user_email}! You can now call /fetch-emails."}
+
 
+@router.get("/accounts", tags=["Authentication"])
+def get_accounts():
+    return {"accounts": list_accounts()}
 
-@app.post("/logout", tags=["Authentication"])
-def logout():
-    creds = get_credentials()
+
+@router.post("/logout", tags=["Authentication"])
+async def logout(account: Optional[str] = None):
+    account = await run_in_threadpool(resolve_account, account)
+    creds = await run_in_threadpool(get_credentials, account)
     if not creds or not creds.token:
         raise HTTPException(status_code=401, detail="No active session found")
 
     try:
         revoke_url = "https://oauth2.googleapis.com/revoke"
-        response = requests.post(
+        response = await gmail_async.get_client().post(
             revoke_url,
             params={"token": creds.token},
             headers={"content-type": "application/x-www-form-urlencoded"}
         )
 
         if response.status_code == 200:
-            if os.path.exists("token.json"):
-                os.remove("token.json")
+            await run_in_threadpool(clear_credentials, account)
             return {"message": "✅ Successfully logged out and token revoked."}
         else:
             raise HTTPException(
@@ -74,86 +171,518 @@ def logout():
 
 # ---------------- MAILS ----------------
 
-@app.get("/emails", response_model=List[EmailSchema], tags=["Mails"])
-def get_all_emails(db: Session = Depends(get_db)):
-    return db.query(Email).all()
+async def _cache_call(fn, *args):
+    """Call into the cache from an async route; a Redis round trip must not block the event loop."""
+    if isinstance(get_cache(), MemoryCache):
+        return fn(*args)
+    return await run_in_threadpool(fn, *args)
+
+
+def _json_response(request, body):
+    """Serve a cached JSON body with its ETag, or a 304 if the client has it."""
+    etag = etag_for(body)
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+
+def _naive_utc(value):
+    # Email.date is timezone-naive; asyncpg will not compare it with an aware datetime
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _encode_cursor(date, row_id):
+    raw = json.dumps([date.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        date_str, email_id = json.loads(raw)
+        return datetime.fromisoformat(date_str), int(email_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("/emails", response_model=EmailPageSchema, tags=["Mails"])
+async def get_all_emails(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    account: Optional[str] = None,
+    from_email: Optional[str] = None,
+    is_starred: Optional[int] = Query(None, ge=0, le=1),
+    label: Optional[List[str]] = Query(None),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Newest-first listing with keyset pagination on (date, id).
+    Pass the returned next_cursor back as ?cursor= to get the next page.
+    Repeat ?label= (any Gmail label id, e.g. IMPORTANT or Label_12) to
+    require several labels.
+    """
+    key = await _cache_call(listing_key, "emails:list", request.query_params.multi_items())
+    body = await _cache_call(get_cache().get, key)
+    if body is not None:
+        return _json_response(request, body)
+
+    query = select(Email).options(selectinload(Email.attachments), selectinload(Email.labels))
+
+    if account is not None:
+        account_id = select(Account.id).where(Account.email == account).scalar_subquery()
+        query = query.where(Email.account_id == account_id)
+    if from_email is not None:
+        query = query.where(Email.from_email == from_email)
+    if is_starred is not None:
+        query = query.where(Email.is_starred == is_starred)
+    for label_id in label or []:
+        query = query.where(Email.id.in_(
+            select(EmailLabel.email_id).where(EmailLabel.label_id == label_id)
+        ))
+    if date_from is not None:
+        query = query.where(Email.date >= _naive_utc(date_from))
+    if date_to is not None:
+        query = query.where(Email.date < _naive_utc(date_to))
+    if cursor:
+        query = query.where(tuple_(Email.date, Email.id) < _decode_cursor(cursor))
+
+    result = await db.scalars(query.order_by(Email.date.desc(), Email.id.desc()).limit(limit + 1))
+    rows = result.all()
+    items = rows[:limit]
+    next_cursor = _encode_cursor(items[-1].date, items[-1].id) if len(rows) > limit else None
+    page = EmailPageSchema.model_validate({"items": items, "next_cursor": next_cursor}, from_attributes=True)
+    body = page.model_dump_json().encode()
+    await _cache_call(get_cache().set, key, body)
+    return _json_response(request, body)
+
+
+@router.get("/emails/search", response_model=EmailSearchPageSchema, tags=["Mails"])
+def search_emails_endpoint(
+    request: Request,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=10000),
+    account: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """Full-text search over subject, sender and body, best matches first."""
+    q = q.strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="Search query has no terms")
+    key = listing_key("emails:search", request.query_params.multi_items())
+    body = get_cache().get(key)
+    if body is not None:
+        return _json_response(request, body)
+
+    account_id = None
+    if account is not None:
+        account_id = db.query(Account.id).filter(Account.email == account).scalar()
+        if account_id is None:
+            return {"items": [], "next_offset": None}
+
+    hits = search_emails(db, q, limit + 1, offset, account_id)
+    next_offset = offset + limit if len(hits) > limit else None
+    page = EmailSearchPageSchema(items=hits[:limit], next_offset=next_offset)
+    body = page.model_dump_json().encode()
+    get_cache().set(key, body)
+    return _json_response(request, body)
+
+
+async def _change_events(request, since, account, limit):
+    """SSE stream of the change feed; each event's id is its seq."""
+    yield f"retry: {int(CHANGES_POLL_INTERVAL * 1000)}\n\n"
+    quiet_since = time.monotonic()
+    while not await request.is_disconnected():
+        async with AsyncSessionLocal() as db:
+            page = await read_changes(db, since, account, limit)
+        for item in page.items:
+            yield f"id: {item.seq}\nevent: change\ndata: {item.model_dump_json()}\n\n"
+        since = page.next_since
+        if len(page.items) == limit:
+            continue
+        if page.items:
+            quiet_since = time.monotonic()
+        elif time.monotonic() - quiet_since >= SSE_HEARTBEAT:
+            # Keeps proxies from closing an idle stream
+            yield ": keep-alive\n\n"
+            quiet_since = time.monotonic()
+        await asyncio.sleep(CHANGES_POLL_INTERVAL)
+
+
+@router.get("/emails/changes", response_model=EmailChangePageSchema, tags=["Mails"])
+async def email_changes(
+    request: Request,
+    since: int = Query(0, ge=0),
+    limit: int = Query(500, ge=1, le=1000),
+    account: Optional[str] = None,
+    wait: float = Query(0, ge=0, le=CHANGES_MAX_WAIT),
+    last_event_id: Optional[int] = Header(None),
+):
+    """
+    Inserts, updates and deletes (tombstones) after seq `since`, oldest
+    first. Pass next_since back as ?since= to continue. With ?wait=N the
+    request is held up to N seconds until a change arrives (long-poll);
+    with Accept: text/event-stream the changes are streamed as SSE, and a
+    reconnecting EventSource resumes from its Last-Event-ID.
+    410 means the changes after `since` were pruned: reload /emails.
+    """
+    since = max(since, last_event_id or 0)
+    async with AsyncSessionLocal() as db:
+        if await is_expired(db, since):
+            raise HTTPException(status_code=410, detail="Changes since this seq were pruned; reload /emails")
+
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            _change_events(request, since, account, limit),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    # Each check takes a fresh session, so a waiting request holds no connection
+    deadline = time.monotonic() + wait
+    while True:
+        async with AsyncSessionLocal() as db:
+            page = await read_changes(db, since, account, limit)
+        remaining = deadline - time.monotonic()
+        if page.items or remaining <= 0:
+            return page
+        await asyncio.sleep(min(CHANGES_POLL_INTERVAL, remaining))
+
+
+EXPORT_COLUMNS = [
+    Email.id, Email.subject, Email.from_email, Email.to_email, Email.date,
+    Email.message_id, Email.body, Email.is_starred, Email.updated_at,
+]
+EXPORT_BATCH_SIZE = 1000
+
+
+def _export_rows(updated_since):
+    # The request's get_db session is closed before the body streams,
+    # so the generator owns its session.
+    db = SessionLocal()
+    try:
+        stmt = select(*EXPORT_COLUMNS).order_by(Email.updated_at, Email.id)
+        if updated_since is not None:
+            stmt = stmt.where(Email.updated_at > updated_since)
+        result = db.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        for batch in result.partitions():
+            yield batch
+    finally:
+        db.close()
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _export_ndjson(updated_since):
+    for batch in _export_rows(updated_since):
+        yield "".join(
+            json.dumps({k: _json_value(v) for k, v in row._mapping.items()}) + "\n"
+            for row in batch
+        )
+
+
+def _export_csv(updated_since):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([c.key for c in EXPORT_COLUMNS])
+    for batch in _export_rows(updated_since):
+        writer.writerows(batch)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
 
 
-@app.get("/emails/{email_id}", response_model=EmailSchema, tags=["Mails"])
-def get_email_by_id(email_id: int, db: Session = Depends(get_db)):
-    email = db.query(Email).filter(Email.id == email_id).first()
+@router.get("/emails/export", tags=["Mails"])
+def export_emails(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    updated_since: Optional[datetime] = None,
+):
+    """
+    Stream every email (or only those changed after updated_since) ordered by
+    updated_at. The last row's updated_at is the watermark for the next run.
+    """
+    if format == "csv":
+        return StreamingResponse(_export_csv(updated_since), media_type="text/csv")
+    return StreamingResponse(_export_ndjson(updated_since), media_type="application/x-ndjson")
+
+
+@router.get("/emails/{email_id}", response_model=EmailSchema, tags=["Mails"])
+async def get_email_by_id(email_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
+    body = await _cache_call(get_cache().get, email_key(email_id))
+    if body is not None:
+        return _json_response(request, body)
+
+    seen_generation = await _cache_call(generation)
+    email = await db.scalar(
+        select(Email)
+        .options(selectinload(Email.attachments), selectinload(Email.labels))
+        .where(Email.id == email_id)
+    )
     if not email:
         raise HTTPException(status_code=404, detail="Email not found")
-    return email
+    body = EmailSchema.model_validate(email, from_attributes=True).model_dump_json().encode()
+    # A sync that committed meanwhile may have invalidated this row already
+    if await _cache_call(generation) == seen_generation:
+        await _cache_call(cache_email, email, body)
+    return _json_response(request, body)
+
+
+@router.get("/emails/{email_id}/body", response_model=EmailBodySchema, tags=["Mails"])
+def get_email_body(email_id: int, request: Request, db: Session = Depends(get_db)):
+    """Full decoded text/HTML body, stored when syncing with SYNC_BODIES=1."""
+    body = load_body(db, email_id)
+    if body is None:
+        raise HTTPException(status_code=404, detail="No full body stored for this email")
+    return _json_response(request, EmailBodySchema(email_id=email_id, **body).model_dump_json().encode())
+
+
+@router.get("/emails/{email_id}/attachments/{attachment_id}", tags=["Mails"])
+def download_attachment(email_id: int, attachment_id: int, db: Session = Depends(get_db)):
+    """Stream a stored attachment; Range requests are supported for resumable downloads."""
+    attachment = (
+        db.query(Attachment)
+        .filter(Attachment.id == attachment_id, Attachment.email_id == email_id)
+        .first()
+    )
+    if not attachment or not attachment.filepath or not os.path.exists(attachment.filepath):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    return FileResponse(
+        attachment.filepath,
+        media_type=attachment.mime_type or "application/octet-stream",
+        filename=attachment.filename,
+    )
+
+
+def _check_headers(to_email, subject):
+    """400 for recipients or a subject that cannot go into the message headers as they are."""
+    try:
+        format_recipients(to_email)
+        _header(subject)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
 
 
-@app.post("/send-email", tags=["Mails"])
+@router.post("/send-email", tags=["Mails"])
 async def send_email_api(
     to_email: str = Form(...),
     subject: str = Form(...),
     body: str = Form(...),
     attachment: UploadFile = File(None),
-    db: Session = Depends(get_db)
+    attachments: List[UploadFile] = File(None),
+    account: Optional[str] = Form(None),
 ):
-    creds = get_credentials()
+    _check_headers(to_email, subject)
+    creds = await run_in_threadpool(get_credentials, account)
+    uploads = ([attachment] if attachment else []) + (attachments or [])
 
     try:
-        await send_email_with_gmail_api(to_email, subject, body, attachment, creds)
+        await send_email_with_gmail_api(to_email, subject, body, uploads, creds)
         return {"message": "✅ Email sent successfully using Gmail API."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
 
 
+@router.post("/outbox", status_code=202, tags=["Mails"])
+def enqueue_email(
+    to_email: str = Form(...),
+    subject: str = Form(...),
+    body: str = Form(...),
+    attachments: List[UploadFile] = File(None),
+    account: Optional[str] = Form(None),
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    """
+    Queue an email for the outbox workers and return its id immediately.
+    Resending with the same Idempotency-Key header returns the original job.
+    """
+    _check_headers(to_email, subject)
+    account = resolve_account(account)
+    # Checked now rather than failing later in the outbox worker
+    if not account or not get_credentials(account):
+        raise HTTPException(401, "Authentication required. Use /login first.")
+    spooled = [outbox.spool_upload(a) for a in (attachments or []) if a is not None and a.filename]
+    message = outbox.enqueue_message(db, account, to_email, subject, body, spooled, idempotency_key)
+    return {"id": message.id, "status": message.status}
+
+
+@router.post("/outbox/bulk", status_code=202, tags=["Mails"])
+def enqueue_emails_bulk(payload: OutboxBulkIn, db: Session = Depends(get_db)):
+    """Queue many attachment-less emails in one call; ids are returned in request order."""
+    for m in payload.messages:
+        _check_headers(m.to_email, m.subject)
+    account = resolve_account(payload.account)
+    if not account or not get_credentials(account):
+        raise HTTPException(401, "Authentication required. Use /login first.")
+    queued = outbox.enqueue_messages(db, account, [m.model_dump() for m in payload.messages])
+    return {"items": [{"id": message_id, "status": status} for message_id, status in queued]}
+
+
+@router.get("/outbox/{message_id}", response_model=OutboxStatusSchema, tags=["Mails"])
+def outbox_status(message_id: int, db: Session = Depends(get_db)):
+    message = db.query(OutboxMessage).filter(OutboxMessage.id == message_id).first()
+    if not message:
+        raise HTTPException(status_code=404, detail="Outbox message not found")
+    return message
+
+
+# ---------------- THREADS ----------------
+
+@router.get("/threads", response_model=ThreadPageSchema, tags=["Threads"])
+async def get_threads(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    account: Optional[str] = None,
+    is_starred: Optional[bool] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Conversations, most recently active first, with keyset pagination on
+    (last_date, id). Counts, participants and the starred flag are kept up
+    to date by the sync, so this reads one row per thread.
+    """
+    key = await _cache_call(listing_key, "threads:list", request.query_params.multi_items())
+    body = await _cache_call(get_cache().get, key)
+    if body is not None:
+        return _json_response(request, body)
+
+    query = select(Thread)
+    if account is not None:
+        account_id = select(Account.id).where(Account.email == account).scalar_subquery()
+        query = query.where(Thread.account_id == account_id)
+    if is_starred is not None:
+        query = query.where(Thread.starred_count > 0 if is_starred else Thread.starred_count == 0)
+    if cursor:
+        query = query.where(tuple_(Thread.last_date, Thread.id) < _decode_cursor(cursor))
+
+    result = await db.scalars(query.order_by(Thread.last_date.desc(), Thread.id.desc()).limit(limit + 1))
+    rows = result.all()
+    items = rows[:limit]
+    next_cursor = _encode_cursor(items[-1].last_date, items[-1].id) if len(rows) > limit else None
+    page = ThreadPageSchema.model_validate({"items": items, "next_cursor": next_cursor}, from_attributes=True)
+    body = page.model_dump_json().encode()
+    await _cache_call(get_cache().set, key, body)
+    return _json_response(request, body)
+
+
+@router.get("/threads/{thread_id}", response_model=ThreadDetailSchema, tags=["Threads"])
+async def get_thread(thread_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
+    """A thread and its messages, oldest first."""
+    key = await _cache_call(listing_key, "threads:get", [("id", thread_id)])
+    body = await _cache_call(get_cache().get, key)
+    if body is not None:
+        return _json_response(request, body)
+
+    thread = await db.get(Thread, thread_id)
+    if not thread:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    messages = await db.scalars(
+        select(Email)
+        .options(selectinload(Email.attachments), selectinload(Email.labels))
+        .where(Email.account_id == thread.account_id, Email.thread_id == thread.thread_id)
+        .order_by(Email.date, Email.id)
+    )
+    detail = ThreadDetailSchema.model_validate(thread, from_attributes=True)
+    detail.messages = [EmailSchema.model_validate(m, from_attributes=True) for m in messages]
+    body = detail.model_dump_json().encode()
+    await _cache_call(get_cache().set, key, body)
+    return _json_response(request, body)
+
+
 # ---------------- SYNC ----------------
 
-@app.get("/fetch-emails", tags=["Sync mails"])
-def fetch_emails_endpoint(db: Session = Depends(get_db)):
-    creds = get_credentials()
+@router.get("/fetch-emails", tags=["Sync mails"])
+def fetch_emails_endpoint(account: Optional[str] = None, db: Session = Depends(get_db)):
+    creds = get_credentials(account)
     if not creds:
         raise HTTPException(401, "Authentication required. Use /login first.")
     try:
         count = fetch_and_store_emails(creds)
         return {"message": f"Fetched and stored {count} new emails."}
+    except ResyncInProgress as e:
+        raise HTTPException(409, str(e))
     except Exception as e:
         raise HTTPException(500, f"Failed to fetch emails: {str(e)}")
 
 
-@app.post("/gmail/watch", tags=["Sync mails"])
-def start_watch(db: Session = Depends(get_db)):
-    creds = get_credentials()
+@router.get("/sync/progress", tags=["Sync mails"])
+def resync_progress(account: Optional[str] = None, db: Session = Depends(get_db)):
+    account = resolve_account(account)
+    checkpoint = (
+        db.query(ResyncCheckpoint)
+        .join(Account, Account.id == ResyncCheckpoint.account_id)
+        .filter(Account.email == account)
+        .first()
+    )
+    if not checkpoint:
+        raise HTTPException(404, "No resync has run for this account")
+
+    percent = None
+    if checkpoint.estimated_total:
+        percent = min(100.0, round(100.0 * checkpoint.processed / checkpoint.estimated_total, 1))
+    return {
+        "account": account,
+        "status": checkpoint.status,
+        "pages": checkpoint.pages,
+        "processed": checkpoint.processed,
+        "inserted": checkpoint.inserted,
+        "estimated_total": checkpoint.estimated_total,
+        "percent": 100.0 if checkpoint.status == "done" else percent,
+        "error": checkpoint.error,
+        "started_at": checkpoint.started_at,
+        "updated_at": checkpoint.updated_at,
+        "finished_at": checkpoint.finished_at,
+    }
+
+
+@router.get("/gmail/quota", tags=["Sync mails"])
+def gmail_quota():
+    return quota_stats()
+
+
+@router.post("/gmail/watch", tags=["Sync mails"])
+def start_watch(account: Optional[str] = None, db: Session = Depends(get_db)):
+    creds = get_credentials(account)
     if not creds:
         raise HTTPException(401, "Auth required")
 
-    service = build("gmail", "v1", credentials=creds)
+    service = get_gmail_service(creds)
     request = {
         "topicName": "projects/mail-fetcher-470411/topics/gmail-notifications",
         "labelFilterAction": "include"
     }
 
-    res = service.users().watch(userId="me", body=request).execute()
+    res = execute(service.users().watch(userId="me", body=request))
 
     # Persist returned historyId
-    state = _get_or_create_sync_state(db, service)
+    state = _get_or_create_sync_state(db, creds)
     state.last_history_id = str(res.get("historyId", state.last_history_id))
     db.commit()
     return {"message": "Watch started", "historyId": state.last_history_id}
 
 
-@app.post("/gmail/pubsub", tags=["Sync mails"])
-async def gmail_pubsub(request: Request, db: Session = Depends(get_db)):
+@router.post("/gmail/pubsub", tags=["Sync mails"])
+async def gmail_pubsub(request: Request, db: AsyncSession = Depends(get_async_db)):
     """
     Pub/Sub push endpoint.
-    Handles deduplication, skips stale notifications, and ensures history continuity.
+    Acknowledges immediately and queues the historyId for the notifying
+    emailAddress; sync workers coalesce queued notifications per account
+    and skip stale ones.
     """
-    creds = get_credentials()
-    if not creds:
-        print("PubSub ignored: no credentials")
-        return {"status": "ignored: not authenticated"}
-
     body = await request.body()
     if not body:
         # Subscription validation ping
-        print("📭 PubSub ping (empty body) – ignoring")
+        log.info("pubsub ping ignored")
         return {"status": "ok"}
 
     try:
@@ -163,44 +692,32 @@ async def gmail_pubsub(request: Request, db: Session = Depends(get_db)):
 
         if not data_b64:
             # Could be a test notification with no payload
-            print("📭 PubSub message received (no data) – ignoring")
+            log.info("pubsub message without data ignored")
             return {"status": "ok"}
 
         decoded = json.loads(base64.b64decode(data_b64).decode("utf-8"))
-        notif_history_id = str(decoded.get("historyId"))
-        print(f"📨 Pub/Sub notification received. historyId={notif_history_id}")
+        notif_history_id = decoded.get("historyId")
+        log.info("pubsub notification received", extra={
+            "account": decoded.get("emailAddress"), "history_id": notif_history_id,
+        })
 
-        service = build("gmail", "v1", credentials=creds)
-        state = _get_or_create_sync_state(db, service)
+        await enqueue_sync(db, decoded.get("emailAddress"), notif_history_id)
 
-        # Skip stale/duplicate notifications
-        if state.last_history_id and int(notif_history_id) <= int(state.last_history_id):
-            print(f"⏭️ Skipping stale notification (notif={notif_history_id}, last={state.last_history_id})")
-            return {"status": "ok"}
+    except Exception:
+        log.exception("pubsub notification failed")
 
-        try:
-            new_last = sync_history(creds, state.last_history_id or notif_history_id)
-
-            if new_last:
-                state.last_history_id = str(new_last)
-                db.commit()
-                print(f"✅ Sync successful. Updated last_history_id={state.last_history_id}")
-            else:
-                print("⚠️ sync_history returned no new historyId")
-
-        except Exception as e:
-            from googleapiclient.errors import HttpError
-            if isinstance(e, HttpError) and e.resp.status == 404:
-                print("⚠️ HistoryId expired. Performing full refetch.")
-                fetch_and_store_emails(creds)
-                profile = service.users().getProfile(userId="me").execute()
-                state.last_history_id = str(profile.get("historyId"))
-                db.commit()
-                print(f"🔄 Rebased last_history_id={state.last_history_id}")
-            else:
-                raise
+    return {"status": "ok"}
 
-    except Exception as e:
-        print("❌ PubSub error:", str(e))
 
-    return {"status": "ok"}
+def create_app():
+    """
+    Application factory, for `uvicorn main:create_app --factory`. Sync and
+    outbox workers start with the lifespan; run `python init_db.py` first.
+    """
+    app = FastAPI(lifespan=lifespan)
+    app.middleware("http")(trace_and_time)
+    app.include_router(router)
+    return app
+
+
+app = create_app()
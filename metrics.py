@@ -0,0 +1,141 @@
+import time, bisect, threading
+from collections import defaultdict
+
+# Minimal in-process metrics rendered in the Prometheus text format by
+# GET /metrics. Histograms use cumulative le buckets like prometheus_client.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LAG_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0)
+
+_registry = []
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + body + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # key -> [bucket counts..., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self._lock:
+            return sum(self._values.get(key, [0.0])[:-1])
+
+    def render(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        lines = self._header()
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---- Metrics shared across modules ----
+
+GMAIL_REQUEST_SECONDS = Histogram(
+    "gmail_request_duration_seconds", "Gmail API call latency per attempt", ["method", "outcome"])
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "SQL statement latency", ["statement"])
+DB_COMMIT_SECONDS = Histogram(
+    "db_commit_duration_seconds", "Session commit latency, flush included")
+EMAILS_INGESTED = Counter(
+    "emails_ingested_total", "Emails inserted into the mirror; rate() gives messages per second", ["source"])
+PUBSUB_TO_COMMIT_SECONDS = Histogram(
+    "pubsub_notification_to_commit_seconds",
+    "Time from a Pub/Sub notification being queued to its sync committing", buckets=LAG_BUCKETS)
+HISTORY_ID_LAG = Gauge(
+    "gmail_history_id_lag", "Latest notified historyId minus the last synced historyId", ["account"])
+TOKEN_REFRESHES = Counter(
+    "oauth_token_refreshes_total", "OAuth access token refreshes", ["outcome"])
+TOKEN_REFRESH_SECONDS = Histogram(
+    "oauth_token_refresh_duration_seconds", "OAuth access token refresh latency")
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "API request latency per route", ["method", "route", "status"])
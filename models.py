@@ -1,28 +1,136 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, LargeBinary, UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, LargeBinary, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
+from datetime import datetime
+import json
 from database import Base
 
+class Account(Base):
+    """A mirrored Gmail mailbox. Its OAuth token lives in auth.TOKEN_DIR."""
+    __tablename__ = "accounts"
+    id = Column(Integer, primary_key=True, index=True)
+    email = Column(String, unique=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 class Email(Base):
     __tablename__ = "emails"
     id = Column(Integer, primary_key=True, index=True)
+    account_id = Column(Integer, ForeignKey("accounts.id"), index=True)
     subject = Column(String)
     from_email = Column(String)
     to_email = Column(String)
     date = Column(DateTime)
-    message_id = Column(String, unique=True, index=True)
+    message_id = Column(String, index=True)
+    thread_id = Column(String)  # Gmail threadId
     body = Column(Text)
     is_starred = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     attachments = relationship("Attachment", back_populates="email")
+    labels = relationship("EmailLabel")
+
+    @property
+    def label_ids(self):
+        return sorted(label.label_id for label in self.labels)
+
+    # Gmail message IDs are only unique within one mailbox.
+    # Keyset pagination on (date, id), optionally narrowed by account, sender or star.
+    __table_args__ = (
+        UniqueConstraint("account_id", "message_id", name="uq_emails_account_message"),
+        Index("ix_emails_account_date_id", "account_id", "date", "id"),
+        Index("ix_emails_date_id", "date", "id"),
+        Index("ix_emails_from_date_id", "from_email", "date", "id"),
+        Index("ix_emails_starred_date_id", "is_starred", "date", "id"),
+        Index("ix_emails_account_thread_date", "account_id", "thread_id", "date"),
+    )
+
+
+class Thread(Base):
+    """
+    A Gmail conversation with its aggregates, maintained by ingestion (see
+    threads.py) so thread listings never group emails at read time.
+    """
+    __tablename__ = "threads"
+    id = Column(Integer, primary_key=True, index=True)
+    account_id = Column(Integer, ForeignKey("accounts.id"))
+    thread_id = Column(String)  # Gmail threadId
+    subject = Column(String)  # of the latest message, like snippet
+    snippet = Column(Text)
+    message_count = Column(Integer, default=0)
+    starred_count = Column(Integer, default=0)
+    last_date = Column(DateTime)
+    participants_json = Column("participants", Text, default="[]")
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @property
+    def participants(self):
+        return json.loads(self.participants_json or "[]")
+
+    @property
+    def is_starred(self):
+        return bool(self.starred_count)
+
+    __table_args__ = (
+        UniqueConstraint("account_id", "thread_id", name="uq_threads_account_thread"),
+        Index("ix_threads_account_last_date_id", "account_id", "last_date", "id"),
+        Index("ix_threads_last_date_id", "last_date", "id"),
+    )
 
 class Attachment(Base):
+    """File contents live in the content-addressed store (see attachments.py)."""
     __tablename__ = "attachments"
     id = Column(Integer, primary_key=True, index=True)
-    email_id = Column(Integer, ForeignKey("emails.id"))
+    email_id = Column(Integer, ForeignKey("emails.id", ondelete="CASCADE"), index=True)
     filename = Column(String)
-    content = Column(LargeBinary)
+    mime_type = Column(String)
+    size = Column(Integer)
+    gmail_attachment_id = Column(String)
+    sha256 = Column(String(64), index=True)
     filepath = Column(String)
     email = relationship("Email", back_populates="attachments")
 
+class EmailLabel(Base):
+    """Gmail label ids (system ones like INBOX, and user Label_* ids) per email."""
+    __tablename__ = "email_labels"
+    email_id = Column(Integer, ForeignKey("emails.id", ondelete="CASCADE"), primary_key=True)
+    label_id = Column(String, primary_key=True)
+
+    # Label filters look up emails by label
+    __table_args__ = (
+        Index("ix_email_labels_label_email", "label_id", "email_id"),
+    )
+
+class EmailBody(Base):
+    """
+    Decoded full text/HTML of a message, compressed with `codec` (see
+    bodies.py). Kept out of `emails` so listings never read it.
+    """
+    __tablename__ = "email_bodies"
+    email_id = Column(Integer, ForeignKey("emails.id", ondelete="CASCADE"), primary_key=True)
+    codec = Column(String(8))
+    text = Column(LargeBinary)
+    html = Column(LargeBinary)
+    text_size = Column(Integer)
+    html_size = Column(Integer)
+
+class EmailChange(Base):
+    """
+    Change feed of the mirror, read by GET /emails/changes. seq only grows;
+    deletes leave a tombstone row (op "delete") since the email is gone.
+    """
+    __tablename__ = "email_changes"
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    account_id = Column(Integer, ForeignKey("accounts.id"))
+    email_id = Column(Integer)  # no FK: tombstones outlive the email
+    message_id = Column(String)
+    op = Column(String(8))  # insert | update | delete
+    changed_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        Index("ix_email_changes_account_seq", "account_id", "seq"),
+        # Never hand out a pruned seq again
+        {"sqlite_autoincrement": True},
+    )
+
 class SyncState(Base):
     """
     Stores the last_history_id per Gmail account (email address).
@@ -32,3 +140,78 @@ class SyncState(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_email = Column(String, unique=True, index=True)
     last_history_id = Column(String)
+    last_synced_at = Column(DateTime)
+
+
+class SyncJob(Base):
+    """
+    Durable queue of Pub/Sub notifications waiting for a history sync.
+    Workers claim every pending job of an account at once and sync up to
+    the highest history_id among them.
+    """
+    __tablename__ = "sync_jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    user_email = Column(String, index=True)
+    history_id = Column(BigInteger)
+    status = Column(String, default="pending")  # pending | running | done | failed
+    attempts = Column(Integer, default=0)
+    run_after = Column(DateTime, default=datetime.utcnow)
+    locked_at = Column(DateTime)
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_sync_jobs_status_run_after", "status", "run_after"),
+    )
+
+
+class ResyncCheckpoint(Base):
+    """
+    Progress of the current (or last) full resync of an account. Updated in
+    the same transaction as each page's inserts, so a restarted resync
+    continues from page_token instead of from the top of the mailbox.
+    locked_at is the lease of the process running it (see gmail_utils).
+    """
+    __tablename__ = "resync_checkpoints"
+    id = Column(Integer, primary_key=True, index=True)
+    account_id = Column(Integer, ForeignKey("accounts.id"), unique=True, index=True)
+    status = Column(String, default="running")  # running | done | failed
+    page_token = Column(String)
+    start_history_id = Column(String)
+    estimated_total = Column(Integer)
+    pages = Column(Integer, default=0)
+    processed = Column(Integer, default=0)
+    inserted = Column(Integer, default=0)
+    error = Column(Text)
+    locked_at = Column(DateTime)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+
+class OutboxMessage(Base):
+    """
+    Persisted outbound email. Enqueued by /outbox and sent by the outbox
+    workers; (user_email, idempotency_key) makes client retries safe.
+    """
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True, index=True)
+    user_email = Column(String, index=True)
+    idempotency_key = Column(String)
+    to_email = Column(String)
+    subject = Column(String)
+    body = Column(Text)
+    attachments = Column(Text)  # JSON list of {filename, content_type, path}
+    status = Column(String, default="queued")  # queued | sending | sent | failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    locked_at = Column(DateTime)
+    gmail_message_id = Column(String)
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+
+    __table_args__ = (
+        UniqueConstraint("user_email", "idempotency_key", name="uq_outbox_idempotency"),
+        Index("ix_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
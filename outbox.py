@@ -0,0 +1,266 @@
+import os, json, shutil, threading, time, uuid
+from datetime import datetime, timedelta
+from googleapiclient.errors import HttpError
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from auth import get_credentials
+from database import SessionLocal
+from gmail_service import is_retryable
+from models import OutboxMessage
+from rate_limit import TokenBucket
+from send_gmail import send_message, SpooledAttachment
+from logs import get_logger, new_trace_id
+
+OUTBOX_DIR = os.getenv("OUTBOX_DIR", "outbox")
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+# Messages claimed per DB round trip
+OUTBOX_CLAIM_SIZE = 20
+# Process-wide send budget, on top of each account's Gmail quota bucket
+OUTBOX_SENDS_PER_SECOND = float(os.getenv("OUTBOX_SENDS_PER_SECOND", "2"))
+MAX_ATTEMPTS = 6
+MAX_RETRY_DELAY = timedelta(minutes=30)
+POLL_INTERVAL = 1.0
+# A message still 'sending' after this long belongs to a dead worker.
+SEND_LEASE = timedelta(minutes=15)
+# How often each worker puts messages with an expired lease back in the queue
+RECOVER_INTERVAL = 60.0
+
+_send_budget = TokenBucket(OUTBOX_SENDS_PER_SECOND)
+_stop = threading.Event()
+_threads = []
+log = get_logger("outbox")
+
+
+def spool_upload(upload):
+    """Copy an UploadFile into the outbox directory; returns its attachment record."""
+    os.makedirs(OUTBOX_DIR, exist_ok=True)
+    path = os.path.join(OUTBOX_DIR, uuid.uuid4().hex)
+    upload.file.seek(0)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(upload.file, out, 1024 * 1024)
+    return {"filename": upload.filename, "content_type": upload.content_type, "path": path}
+
+
+def _remove_spooled(attachments):
+    for attachment in attachments:
+        if os.path.exists(attachment["path"]):
+            os.remove(attachment["path"])
+
+
+def enqueue_message(db, user_email, to_email, subject, body, attachments=(), idempotency_key=None):
+    """
+    Queue a message and return its OutboxMessage. A repeated idempotency_key
+    for the same account returns the original message instead.
+    """
+    if idempotency_key:
+        existing = db.query(OutboxMessage).filter_by(
+            user_email=user_email, idempotency_key=idempotency_key
+        ).first()
+        if existing:
+            _remove_spooled(attachments)
+            return existing
+
+    message = OutboxMessage(
+        user_email=user_email,
+        idempotency_key=idempotency_key,
+        to_email=to_email,
+        subject=subject,
+        body=body,
+        attachments=json.dumps(list(attachments)),
+    )
+    db.add(message)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Lost a race with a concurrent request using the same key
+        db.rollback()
+        _remove_spooled(attachments)
+        return db.query(OutboxMessage).filter_by(
+            user_email=user_email, idempotency_key=idempotency_key
+        ).one()
+    db.refresh(message)
+    return message
+
+
+def enqueue_messages(db, user_email, messages):
+    """
+    Queue many attachment-less messages (dicts of to_email, subject, body and
+    idempotency_key) in one transaction. Returns [(id, status)] in order; a
+    key the account already used, or used earlier in the batch, gets the
+    original message instead of a new one.
+    """
+    keys = {m["idempotency_key"] for m in messages if m.get("idempotency_key")}
+    for attempt in range(2):
+        by_key = {}
+        if keys:
+            by_key = {
+                m.idempotency_key: m for m in db.query(OutboxMessage).filter(
+                    OutboxMessage.user_email == user_email, OutboxMessage.idempotency_key.in_(keys)
+                )
+            }
+        queued = []
+        for m in messages:
+            key = m.get("idempotency_key")
+            message = by_key.get(key) if key else None
+            if message is None:
+                message = OutboxMessage(
+                    user_email=user_email, idempotency_key=key, to_email=m["to_email"],
+                    subject=m["subject"], body=m["body"], attachments="[]", status="queued",
+                )
+                db.add(message)
+                if key:
+                    by_key[key] = message
+            queued.append(message)
+        try:
+            db.flush()
+        except IntegrityError:
+            # A concurrent request took one of the keys; the retry finds its message
+            db.rollback()
+            if attempt:
+                raise
+            continue
+        # Read before the commit expires them, which would cost a query per row
+        result = [(m.id, m.status) for m in queued]
+        db.commit()
+        return result
+
+
+def _claim(db, limit=OUTBOX_CLAIM_SIZE):
+    """
+    Mark up to limit due messages 'sending' and return their ids. Each one is
+    taken with a conditional UPDATE that only matches it while still queued,
+    so of concurrent claimers in any process exactly one gets a message, also
+    on SQLite, which ignores FOR UPDATE.
+    """
+    now = datetime.utcnow()
+    candidates = [
+        message_id for (message_id,) in
+        db.query(OutboxMessage.id)
+        .filter(OutboxMessage.status == "queued", OutboxMessage.next_attempt_at <= now)
+        .order_by(OutboxMessage.id)
+        .with_for_update(skip_locked=True)
+        .limit(limit)
+    ]
+    claimed = []
+    for message_id in candidates:
+        taken = (
+            db.query(OutboxMessage)
+            .filter(OutboxMessage.id == message_id, OutboxMessage.status == "queued")
+            .update({
+                "status": "sending",
+                "locked_at": now,
+                "attempts": func.coalesce(OutboxMessage.attempts, 0) + 1,
+            }, synchronize_session=False)
+        )
+        if taken:
+            claimed.append(message_id)
+    db.commit()
+    return claimed
+
+
+def _send_one(db, message):
+    creds = get_credentials(message.user_email)
+    if not creds:
+        raise RuntimeError(f"no credentials stored for {message.user_email}")
+
+    records = json.loads(message.attachments or "[]")
+    files = [open(r["path"], "rb") for r in records]
+    try:
+        attachments = [
+            SpooledAttachment(r["filename"], r["content_type"], f) for r, f in zip(records, files)
+        ]
+        _send_budget.acquire()
+        sent = send_message(
+            creds, message.to_email, message.subject, message.body, attachments,
+            message_id=f"<outbox-{message.id}@gmail-task.local>",
+        )
+    finally:
+        for f in files:
+            f.close()
+
+    message.status = "sent"
+    message.gmail_message_id = sent["id"]
+    message.sent_at = datetime.utcnow()
+    message.error = None
+    _remove_spooled(records)
+
+
+def _fail(message, error):
+    permanent = isinstance(error, HttpError) and not is_retryable(error)
+    message.error = str(error)
+    if permanent or message.attempts >= MAX_ATTEMPTS:
+        message.status = "failed"
+        _remove_spooled(json.loads(message.attachments or "[]"))
+    else:
+        message.status = "queued"
+        delay = min(MAX_RETRY_DELAY, timedelta(seconds=15 * 2 ** message.attempts))
+        message.next_attempt_at = datetime.utcnow() + delay
+
+
+def run_once():
+    """Claim and send one batch. Returns False if nothing was due."""
+    db = SessionLocal()
+    try:
+        ids = _claim(db)
+        if not ids:
+            return False
+        for message in db.query(OutboxMessage).filter(OutboxMessage.id.in_(ids)).order_by(OutboxMessage.id):
+            new_trace_id()
+            try:
+                _send_one(db, message)
+                log.info("outbox message sent", extra={
+                    "outbox_id": message.id, "gmail_message_id": message.gmail_message_id,
+                })
+            except Exception as e:
+                log.warning("outbox message failed", extra={
+                    "outbox_id": message.id, "attempt": message.attempts, "error": str(e),
+                })
+                _fail(message, e)
+            # Commit per message so a crash never re-sends what already went out
+            db.commit()
+        return True
+    finally:
+        db.close()
+
+
+def _worker_loop():
+    next_recovery = 0.0
+    while not _stop.is_set():
+        try:
+            # Not only at startup: a worker may die while this process keeps running
+            if time.monotonic() >= next_recovery:
+                recover_sending_messages()
+                next_recovery = time.monotonic() + RECOVER_INTERVAL
+            if not run_once():
+                _stop.wait(POLL_INTERVAL)
+        except Exception:
+            log.exception("outbox worker error")
+            _stop.wait(POLL_INTERVAL)
+
+
+def recover_sending_messages():
+    """Messages left 'sending' past their lease by a dead worker or process go back to the queue."""
+    db = SessionLocal()
+    try:
+        db.query(OutboxMessage).filter(
+            OutboxMessage.status == "sending",
+            OutboxMessage.locked_at < datetime.utcnow() - SEND_LEASE,
+        ).update({"status": "queued"}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def start_workers(count=OUTBOX_WORKERS):
+    _stop.clear()
+    for i in range(count):
+        t = threading.Thread(target=_worker_loop, name=f"outbox-worker-{i}", daemon=True)
+        t.start()
+        _threads.append(t)
+
+
+def stop_workers(timeout=10):
+    _stop.set()
+    for t in _threads:
+        t.join(timeout)
+    _threads.clear()
@@ -0,0 +1,62 @@
+import asyncio, threading, time
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _fill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available, then take them."""
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                self._fill(time.monotonic())
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        """acquire() for coroutines: waits without blocking the event loop."""
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                self._fill(time.monotonic())
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """
+    TokenBucket whose rate backs off multiplicatively when the server
+    throttles us and creeps back up additively on success (AIMD), so the
+    steady state sits just under the real quota.
+    """
+
+    def __init__(self, rate, min_rate=None, capacity=None):
+        super().__init__(rate, capacity)
+        self.max_rate = self.rate
+        self.min_rate = float(min_rate if min_rate is not None else rate / 10)
+
+    def throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
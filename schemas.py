@@ -6,6 +6,9 @@ class AttachmentSchema(BaseModel):
     id: int
     filename: str
     filepath: Optional[str] = None
+    mime_type: Optional[str] = None
+    size: Optional[int] = None
+    sha256: Optional[str] = None
     class Config: orm_mode = True
 
 class EmailSchema(BaseModel):
@@ -15,7 +18,89 @@ class EmailSchema(BaseModel):
     to_email: str
     date: datetime
     message_id: str
+    thread_id: Optional[str] = None
     body: str
     is_starred: int  
+    label_ids: List[str] = []
     attachments: List[AttachmentSchema] = []
     class Config: orm_mode = True
+
+class EmailBodySchema(BaseModel):
+    email_id: int
+    text: Optional[str] = None
+    html: Optional[str] = None
+
+class EmailPageSchema(BaseModel):
+    items: List[EmailSchema]
+    next_cursor: Optional[str] = None
+
+class EmailSearchHitSchema(BaseModel):
+    id: int
+    subject: Optional[str] = None
+    from_email: Optional[str] = None
+    date: Optional[datetime] = None
+    is_starred: Optional[int] = None
+    rank: float
+    snippet: Optional[str] = None
+
+class EmailSearchPageSchema(BaseModel):
+    items: List[EmailSearchHitSchema]
+    next_offset: Optional[int] = None
+
+class ThreadSchema(BaseModel):
+    id: int
+    thread_id: str
+    subject: Optional[str] = None
+    snippet: Optional[str] = None
+    message_count: int
+    is_starred: bool
+    last_date: Optional[datetime] = None
+    participants: List[str] = []
+    class Config: orm_mode = True
+
+class ThreadPageSchema(BaseModel):
+    items: List[ThreadSchema]
+    next_cursor: Optional[str] = None
+
+class ThreadDetailSchema(ThreadSchema):
+    messages: List[EmailSchema] = []
+
+class EmailChangeSchema(BaseModel):
+    seq: int
+    op: str
+    account_id: int
+    email_id: int
+    message_id: str
+    changed_at: datetime
+    # Current state of the email; None for deletes and for emails deleted since
+    email: Optional[EmailSchema] = None
+    class Config: orm_mode = True
+
+class EmailChangePageSchema(BaseModel):
+    items: List[EmailChangeSchema]
+    next_since: int
+
+class OutboxMessageIn(BaseModel):
+    to_email: str
+    subject: str
+    body: str
+    idempotency_key: Optional[str] = None
+
+class OutboxBulkIn(BaseModel):
+    account: Optional[str] = None
+    messages: List[OutboxMessageIn]
+
+class OutboxStatusSchema(BaseModel):
+    id: int
+    user_email: str
+    idempotency_key: Optional[str] = None
+    to_email: str
+    subject: str
+    status: str
+    attempts: int
+    next_attempt_at: Optional[datetime] = None
+    gmail_message_id: Optional[str] = None
+    error: Optional[str] = None
+    created_at: datetime
+    sent_at: Optional[datetime] = None
+    class Config: orm_mode = True
@@ -0,0 +1,134 @@
+from sqlalchemy import or_, text
+from models import Email
+
+# PostgreSQL: a generated tsvector column (maintained by the database on every
+# insert/update, whichever ingestion path wrote the row) with a GIN index.
+PG_DDL = [
+    """
+    ALTER TABLE emails ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(subject, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(from_email, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(body, '')), 'C')
+    ) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_emails_search_vector ON emails USING GIN (search_vector)",
+]
+
+# SQLite: an external-content FTS5 table kept in step with emails by triggers.
+SQLITE_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+        subject, from_email, body, content='emails', content_rowid='id'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS emails_fts_ai AFTER INSERT ON emails BEGIN
+        INSERT INTO emails_fts(rowid, subject, from_email, body)
+        VALUES (new.id, new.subject, new.from_email, new.body);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS emails_fts_ad AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts(emails_fts, rowid, subject, from_email, body)
+        VALUES ('delete', old.id, old.subject, old.from_email, old.body);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS emails_fts_au AFTER UPDATE OF subject, from_email, body ON emails BEGIN
+        INSERT INTO emails_fts(emails_fts, rowid, subject, from_email, body)
+        VALUES ('delete', old.id, old.subject, old.from_email, old.body);
+        INSERT INTO emails_fts(rowid, subject, from_email, body)
+        VALUES (new.id, new.subject, new.from_email, new.body);
+    END
+    """,
+]
+
+PG_SEARCH = text("""
+    SELECT hit.id, hit.subject, hit.from_email, hit.date, hit.is_starred, hit.rank,
+           ts_headline('english', coalesce(hit.subject, '') || ' — ' || coalesce(hit.body, ''), query,
+                       'StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=20') AS snippet
+    FROM (
+        SELECT e.id, e.subject, e.from_email, e.date, e.is_starred, e.body,
+               ts_rank_cd(e.search_vector, query) AS rank, query
+        FROM emails e, websearch_to_tsquery('english', :q) query
+        WHERE e.search_vector @@ query
+          AND (CAST(:account_id AS INTEGER) IS NULL OR e.account_id = :account_id)
+        ORDER BY rank DESC, e.id DESC
+        LIMIT :limit OFFSET :offset
+    ) hit
+    ORDER BY hit.rank DESC, hit.id DESC
+""")
+
+# bm25() is lower-is-better; weights favour subject over sender over body.
+SQLITE_SEARCH = text("""
+    SELECT e.id, e.subject, e.from_email, e.date, e.is_starred,
+           -bm25(emails_fts, 10.0, 5.0, 1.0) AS rank,
+           snippet(emails_fts, -1, '<mark>', '</mark>', '…', 16) AS snippet
+    FROM emails_fts JOIN emails e ON e.id = emails_fts.rowid
+    WHERE emails_fts MATCH :q
+      AND (:account_id IS NULL OR e.account_id = :account_id)
+    ORDER BY bm25(emails_fts, 10.0, 5.0, 1.0), e.id DESC
+    LIMIT :limit OFFSET :offset
+""")
+
+
+def ensure_search_index(engine):
+    """Create the full-text index if missing (idempotent) and backfill it."""
+    dialect = engine.dialect.name
+    with engine.begin() as conn:
+        if dialect == "postgresql":
+            for ddl in PG_DDL:
+                conn.execute(text(ddl))
+        elif dialect == "sqlite":
+            exists = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE name = 'emails_fts'"
+            )).first()
+            for ddl in SQLITE_DDL:
+                conn.execute(text(ddl))
+            if not exists:
+                conn.execute(text("INSERT INTO emails_fts(emails_fts) VALUES ('rebuild')"))
+
+
+def _fts5_query(q):
+    # Quote every term so user input cannot use FTS5 query syntax.
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in q.split())
+
+
+def _like_pattern(term):
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _like_search(db, q, limit, offset, account_id):
+    # Databases without a full-text index: every term has to appear in the
+    # subject, sender or body. Unranked, newest first; a full scan of emails.
+    columns = (Email.subject, Email.from_email, Email.body)
+    query = db.query(Email.id, Email.subject, Email.from_email, Email.date, Email.is_starred, Email.body)
+    for term in q.split():
+        pattern = _like_pattern(term)
+        query = query.filter(or_(*(c.ilike(pattern, escape="\\") for c in columns)))
+    if account_id is not None:
+        query = query.filter(Email.account_id == account_id)
+    rows = query.order_by(Email.date.desc(), Email.id.desc()).limit(limit).offset(offset)
+    return [
+        dict(id=r.id, subject=r.subject, from_email=r.from_email, date=r.date,
+             is_starred=r.is_starred, rank=0.0, snippet=r.body)
+        for r in rows
+    ]
+
+
+def search_emails(db, q, limit=20, offset=0, account_id=None):
+    """Ranked full-text hits over subject, sender and body, with highlighted snippets."""
+    if not q.split():
+        # FTS5 rejects an empty MATCH; no terms matches nothing
+        return []
+    dialect = db.get_bind().dialect.name
+    params = {"q": q, "limit": limit, "offset": offset, "account_id": account_id}
+    if dialect == "postgresql":
+        rows = db.execute(PG_SEARCH, params)
+    elif dialect == "sqlite":
+        params["q"] = _fts5_query(q)
+        rows = db.execute(SQLITE_SEARCH, params)
+    else:
+        return _like_search(db, q, limit, offset, account_id)
+    return [dict(row._mapping) for row in rows]
@@ -1,49 +1,164 @@
 # send_gmail.py
 
-from googleapiclient.discovery import build
+from gmail_service import get_gmail_service, get_email_address, execute
 from googleapiclient.errors import HttpError
-from email.mime.multipart import MIMEMultipart
+from googleapiclient.http import MediaFileUpload
+from email.header import Header
 from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication 
-import base64
+from email.utils import encode_rfc2231, formataddr, formatdate, getaddresses, make_msgid
+from starlette.concurrency import run_in_threadpool
+import base64, mimetypes, os, tempfile, uuid
 from fastapi import UploadFile
+from collections import namedtuple
+from logs import get_logger
+import gmail_async
+
+log = get_logger("send_gmail")
+
+# Messages above this size are sent with a resumable upload in chunks;
+# smaller ones go up in a single multipart upload request.
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+# Multiple of 57 bytes, so every base64 line is a full 76 characters
+B64_READ_SIZE = 57 * 1024
+
+
+# Attachment read from a file on disk instead of an UploadFile
+SpooledAttachment = namedtuple("SpooledAttachment", "filename content_type file")
+
+
+def _header(value):
+    # A line break would end the header and let the value add headers of its own
+    if "\r" in value or "\n" in value:
+        raise ValueError("Header values must not contain line breaks")
+    return Header(value, "utf-8").encode() if not value.isascii() else value
+
+
+def format_recipients(to_email):
+    """
+    The To: header for a comma-separated recipient list, with display names
+    RFC 2047-encoded. Raises ValueError for line breaks or missing addresses.
+    """
+    if "\r" in to_email or "\n" in to_email:
+        raise ValueError("Recipients must not contain line breaks")
+    recipients = getaddresses([to_email])
+    if not recipients or not all("@" in addr for _, addr in recipients):
+        raise ValueError(f"Invalid recipient address: {to_email!r}")
+    return ", ".join(formataddr((name, addr), "utf-8") for name, addr in recipients)
+
+
+def _attachment_headers(upload):
+    filename = os.path.basename(upload.filename or "attachment")
+    content_type = (
+        upload.content_type
+        or mimetypes.guess_type(filename)[0]
+        or "application/octet-stream"
+    )
+    if filename.isascii():
+        quoted = filename.replace("\\", "\\\\").replace('"', '\\"')
+        name_params = f'name="{quoted}"', f'filename="{quoted}"'
+    else:
+        encoded = encode_rfc2231(filename, "utf-8")
+        name_params = f"name*={encoded}", f"filename*={encoded}"
+    return (
+        f"Content-Type: {content_type}; {name_params[0]}\r\n"
+        f"Content-Transfer-Encoding: base64\r\n"
+        f"Content-Disposition: attachment; {name_params[1]}\r\n\r\n"
+    )
+
+
+def _write_message(out, from_email, to_email, subject, body, attachments, message_id=None):
+    """Stream the RFC 822 message into `out`, base64-encoding attachments chunk by chunk."""
+    boundary = f"=_{uuid.uuid4().hex}"
+    out.write((
+        f"To: {format_recipients(to_email)}\r\n"
+        f"From: {from_email}\r\n"
+        f"Subject: {_header(subject)}\r\n"
+        f"Date: {formatdate(localtime=True)}\r\n"
+        f"Message-ID: {message_id or make_msgid()}\r\n"
+        f"MIME-Version: 1.0\r\n"
+        f'Content-Type: multipart/mixed; boundary="{boundary}"\r\n\r\n'
+    ).encode())
+
+    text_part = MIMEText(body, "plain", "utf-8")
+    out.write(f"--{boundary}\r\n".encode())
+    out.write(text_part.as_bytes().replace(b"\n", b"\r\n"))
+    out.write(b"\r\n")
+
+    for upload in attachments:
+        out.write(f"--{boundary}\r\n".encode())
+        out.write(_attachment_headers(upload).encode())
+        upload.file.seek(0)
+        while True:
+            chunk = upload.file.read(B64_READ_SIZE)
+            if not chunk:
+                break
+            encoded = base64.b64encode(chunk)
+            for i in range(0, len(encoded), 76):
+                out.write(encoded[i:i + 76] + b"\r\n")
+
+    out.write(f"--{boundary}--\r\n".encode())
+
+
+def _spool_message(from_email, to_email, subject, body, attachments, message_id=None):
+    """Write the message to a temp .eml file and return its path; the caller removes it."""
+    # Attachments are read from the uploads' spooled temp files and the
+    # message is assembled on disk, so memory stays bounded by the chunk size.
+    fd, path = tempfile.mkstemp(prefix="outgoing-", suffix=".eml")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            _write_message(out, from_email, to_email, subject, body, attachments, message_id)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def send_message(creds, to_email, subject, body, attachments=(), message_id=None):
+    """
+    Blocking send. `attachments` are objects with filename, content_type and
+    a binary `file` (UploadFile, or SpooledAttachment for queued mail).
+    """
+    service = get_gmail_service(creds)
+    from_email = get_email_address(creds)
+
+    path = _spool_message(from_email, to_email, subject, body, attachments, message_id)
+    try:
+        resumable = os.path.getsize(path) > RESUMABLE_THRESHOLD
+        media = MediaFileUpload(
+            path,
+            mimetype="message/rfc822",
+            resumable=resumable,
+            chunksize=UPLOAD_CHUNK_SIZE if resumable else -1,
+        )
+        request = service.users().messages().send(userId="me", body={}, media_body=media)
+        return execute(request, idempotent=False)
+    finally:
+        os.remove(path)
+
 
 # Make the function asynchronous
-async def send_email_with_gmail_api(to_email: str, subject: str, body: str, attachment: UploadFile = None, creds = None):
+async def send_email_with_gmail_api(to_email: str, subject: str, body: str, attachments=None, creds=None):
     """Send an email using Gmail API"""
+    if isinstance(attachments, UploadFile):
+        attachments = [attachments]
+    attachments = [a for a in (attachments or []) if a is not None and a.filename]
+
     try:
-        service = build('gmail', 'v1', credentials=creds)
-        
-        user_info = service.users().getProfile(userId="me").execute()
-        from_email = user_info['emailAddress']
-        
-        message = MIMEMultipart()
-        message['to'] = to_email
-        message['from'] = from_email
-        message['subject'] = subject
-        
-        message.attach(MIMEText(body, 'plain'))
-
-        # Attach the file if provided
-        if attachment:
-            # ✅ Use await to read the file asynchronously
-            attachment_data = await attachment.read()
-            
-            # ✅ Use MIMEApplication for generic file attachments
-            attach_part = MIMEApplication(attachment_data, Name=attachment.filename)
-            
-            # This header tells the email client to treat it as an attachment
-            attach_part['Content-Disposition'] = f'attachment; filename="{attachment.filename}"'
-            message.attach(attach_part)
-        
-            
-
-        raw_message = {'raw': base64.urlsafe_b64encode(message.as_bytes()).decode()}
-        sent_message = service.users().messages().send(userId="me", body=raw_message).execute()
-        
-        print(f'Email sent: {sent_message["id"]}')
+        from_email = await gmail_async.get_email_address(creds)
+        # Only the disk work runs in the threadpool; the upload itself is
+        # awaited on the shared connection pool.
+        path = await run_in_threadpool(_spool_message, from_email, to_email, subject, body, attachments)
+        try:
+            sent_message = await gmail_async.send_message_file(
+                creds, path, RESUMABLE_THRESHOLD, UPLOAD_CHUNK_SIZE
+            )
+        finally:
+            os.remove(path)
+        log.info("email sent", extra={"gmail_message_id": sent_message["id"]})
+        return sent_message
 
     except HttpError as error:
-        print(f'An error occurred: {error}')
+        log.error("email send failed", extra={"error": str(error)})
         # Re-raise the exception so the FastAPI endpoint can catch it
-        raise error 
\ No newline at end of file
+        raise error
@@ -0,0 +1,345 @@
+import os, threading, time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from googleapiclient.errors import HttpError
+from sqlalchemy import or_, select, text
+from auth import get_credentials, list_accounts
+from database import SessionLocal
+from gmail_utils import (
+    RESYNC_LEASE, ResyncInProgress, fetch_and_store_emails, sync_history, _get_or_create_sync_state,
+)
+from models import Account, ResyncCheckpoint, SyncJob, SyncState
+from changes import prune_changes
+from metrics import PUBSUB_TO_COMMIT_SECONDS, HISTORY_ID_LAG
+from logs import get_logger, new_trace_id
+
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "2"))
+POLL_INTERVAL = 1.0
+MAX_ATTEMPTS = 5
+# A job still 'running' after this long belongs to a dead worker.
+JOB_LEASE = timedelta(minutes=15)
+# How often a running sync renews its jobs' lease, and how often each worker
+# puts jobs with an expired lease back in the queue
+LEASE_RENEW_INTERVAL = 60.0
+RECOVER_INTERVAL = 60.0
+# How often to look for resyncs abandoned by a dead process
+RESUME_INTERVAL = 60.0
+# Namespace of the pg_advisory_xact_lock keys taken by _claim
+CLAIM_LOCK_NAMESPACE = 5801
+# Minimum gap between two syncs of the same account; notifications that
+# arrive meanwhile are coalesced into the next sync.
+ACCOUNT_SYNC_INTERVAL = timedelta(seconds=int(os.getenv("ACCOUNT_SYNC_INTERVAL", "5")))
+
+_stop = threading.Event()
+_threads = []
+# Accounts being synced by this process. Across processes, _claim takes a
+# per-account advisory lock and re-checks for running jobs under it.
+_active_accounts = set()
+_active_lock = threading.Lock()
+log = get_logger("sync_worker")
+
+
+async def enqueue_sync(db, user_email, history_id):
+    """Queue a sync from the Pub/Sub handler; `db` is an AsyncSession."""
+    if not user_email:
+        # _claim never matches a NULL account, so the job would sit in the queue forever
+        raise ValueError("notification has no emailAddress")
+    db.add(SyncJob(user_email=user_email, history_id=int(history_id)))
+    await db.commit()
+    last = await db.scalar(
+        select(SyncState.last_history_id).where(SyncState.user_email == user_email)
+    )
+    if last:
+        HISTORY_ID_LAG.set(max(0, int(history_id) - int(last)), account=user_email)
+
+
+def _lock_account(db, user_email):
+    """
+    Serialize claims of one account across processes until the claiming
+    transaction ends. SQLite needs nothing: it runs one writer at a time.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(
+            text("SELECT pg_advisory_xact_lock(:namespace, hashtext(:account))"),
+            {"namespace": CLAIM_LOCK_NAMESPACE, "account": user_email},
+        )
+
+
+def _claim(db):
+    """
+    Claim all pending jobs of one account that is not already being synced.
+    The least recently synced account goes first, so busy mailboxes cannot
+    starve quiet ones. Returns (user_email, max_history_id, job_ids,
+    oldest_created_at) or None.
+    """
+    now = datetime.utcnow()
+    running = db.query(SyncJob.user_email).filter(SyncJob.status == "running")
+    recently_synced = db.query(SyncState.user_email).filter(
+        SyncState.last_synced_at > now - ACCOUNT_SYNC_INTERVAL
+    )
+
+    with _active_lock:
+        job = (
+            db.query(SyncJob)
+            .outerjoin(SyncState, SyncState.user_email == SyncJob.user_email)
+            .filter(SyncJob.status == "pending", SyncJob.run_after <= now)
+            .filter(~SyncJob.user_email.in_(running))
+            .filter(~SyncJob.user_email.in_(recently_synced))
+            .filter(~SyncJob.user_email.in_(_active_accounts or [""]))
+            .order_by(SyncState.last_synced_at.asc().nulls_first(), SyncJob.id)
+            .with_for_update(of=SyncJob, skip_locked=True)
+            .first()
+        )
+        if not job:
+            db.rollback()
+            return None
+
+        # Another process may have claimed a different pending job of this
+        # account since the query above; under the lock its commit is visible.
+        _lock_account(db, job.user_email)
+        if db.query(running.filter(SyncJob.user_email == job.user_email).exists()).scalar():
+            db.rollback()
+            return None
+
+        jobs = (
+            db.query(SyncJob)
+            .filter(SyncJob.user_email == job.user_email, SyncJob.status == "pending")
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for j in jobs:
+            j.status = "running"
+            j.locked_at = now
+            j.attempts = (j.attempts or 0) + 1
+        db.commit()
+        _active_accounts.add(job.user_email)
+
+    return (
+        job.user_email,
+        max(j.history_id for j in jobs),
+        [j.id for j in jobs],
+        min(j.created_at for j in jobs),
+    )
+
+
+def process_account(user_email, history_id):
+    """Bring the mailbox up to at least history_id (what gmail_pubsub used to do inline)."""
+    creds = get_credentials(user_email)
+    if not creds:
+        raise RuntimeError(f"no credentials stored for {user_email}")
+
+    db = SessionLocal()
+    try:
+        state = _get_or_create_sync_state(db, creds)
+
+        if state.last_history_id and history_id <= int(state.last_history_id):
+            log.info("skipping stale notification", extra={
+                "account": user_email, "history_id": history_id, "last_history_id": state.last_history_id,
+            })
+            return
+
+        try:
+            new_last = sync_history(creds, state.last_history_id or str(history_id))
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            log.warning("history id expired, running full resync", extra={"account": user_email})
+            fetch_and_store_emails(creds)
+            db.refresh(state)
+            new_last = state.last_history_id
+
+        db.refresh(state)
+        state.last_synced_at = datetime.utcnow()
+        if new_last:
+            state.last_history_id = str(new_last)
+        db.commit()
+
+        if state.last_history_id:
+            HISTORY_ID_LAG.set(max(0, history_id - int(state.last_history_id)), account=user_email)
+        if new_last:
+            log.info("sync committed", extra={"account": user_email, "last_history_id": state.last_history_id})
+        else:
+            log.warning("sync_history returned no historyId", extra={"account": user_email})
+    finally:
+        db.close()
+
+
+def _finish(job_ids, error=None):
+    db = SessionLocal()
+    try:
+        for job in db.query(SyncJob).filter(SyncJob.id.in_(job_ids)):
+            if error is None:
+                job.status = "done"
+                job.error = None
+            elif job.attempts >= MAX_ATTEMPTS:
+                job.status = "failed"
+                job.error = error
+            else:
+                job.status = "pending"
+                job.error = error
+                job.run_after = datetime.utcnow() + timedelta(seconds=2 ** job.attempts)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _renew_lease(job_ids, done):
+    while not done.wait(LEASE_RENEW_INTERVAL):
+        db = SessionLocal()
+        try:
+            db.query(SyncJob).filter(SyncJob.id.in_(job_ids), SyncJob.status == "running").update(
+                {"locked_at": datetime.utcnow()}, synchronize_session=False
+            )
+            db.commit()
+        except Exception:
+            # The next renewal retries; the lease outlasts several misses
+            log.exception("sync job lease renewal failed", extra={"jobs": job_ids})
+        finally:
+            db.close()
+
+
+@contextmanager
+def _held_lease(job_ids):
+    """Keep the claimed jobs' lease alive while the block runs, however long the sync takes."""
+    done = threading.Event()
+    renewer = threading.Thread(target=_renew_lease, args=(job_ids, done), name="sync-lease", daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        done.set()
+        renewer.join()
+
+
+def run_once():
+    """Claim and process one account's pending jobs. Returns False if the queue was empty."""
+    db = SessionLocal()
+    try:
+        claimed = _claim(db)
+    finally:
+        db.close()
+    if not claimed:
+        return False
+
+    user_email, history_id, job_ids, queued_at = claimed
+    new_trace_id()
+    log.info("syncing account", extra={
+        "account": user_email, "history_id": history_id, "notifications": len(job_ids),
+    })
+    try:
+        with _held_lease(job_ids):
+            process_account(user_email, history_id)
+        PUBSUB_TO_COMMIT_SECONDS.observe((datetime.utcnow() - queued_at).total_seconds())
+        _finish(job_ids)
+    except Exception as e:
+        log.exception("sync job failed", extra={"account": user_email})
+        _finish(job_ids, error=str(e))
+    finally:
+        with _active_lock:
+            _active_accounts.discard(user_email)
+    return True
+
+
+def _prune_changes():
+    db = SessionLocal()
+    try:
+        prune_changes(db)
+    finally:
+        db.close()
+
+
+def _worker_loop():
+    next_recovery = 0.0
+    while not _stop.is_set():
+        try:
+            # Not only at startup: a process restarted within JOB_LEASE left its jobs running
+            if time.monotonic() >= next_recovery:
+                recover_running_jobs()
+                next_recovery = time.monotonic() + RECOVER_INTERVAL
+            if not run_once():
+                _prune_changes()
+                _stop.wait(POLL_INTERVAL)
+        except Exception:
+            log.exception("sync worker error")
+            _stop.wait(POLL_INTERVAL)
+
+
+def recover_running_jobs():
+    """Jobs whose lease ran out, left 'running' by a dead worker or process, go back to the queue."""
+    db = SessionLocal()
+    try:
+        db.query(SyncJob).filter(
+            SyncJob.status == "running",
+            SyncJob.locked_at < datetime.utcnow() - JOB_LEASE,
+        ).update(
+            {"status": "pending"}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def resume_interrupted_resyncs():
+    """
+    Continue full resyncs whose process died, from their checkpoints. Failed
+    resyncs are left to the next sync of the account, not retried here.
+    """
+    db = SessionLocal()
+    try:
+        accounts = [
+            a.email for a in db.query(Account)
+            .join(ResyncCheckpoint, ResyncCheckpoint.account_id == Account.id)
+            .filter(
+                ResyncCheckpoint.status == "running",
+                or_(
+                    ResyncCheckpoint.locked_at.is_(None),
+                    ResyncCheckpoint.locked_at < datetime.utcnow() - RESYNC_LEASE,
+                ),
+            )
+        ]
+    finally:
+        db.close()
+
+    # Accounts logged out since their resync started are skipped
+    stored = set(list_accounts())
+    for user_email in accounts:
+        creds = get_credentials(user_email) if user_email in stored else None
+        if not creds:
+            continue
+        try:
+            new_trace_id()
+            log.info("resuming interrupted resync", extra={"account": user_email})
+            fetch_and_store_emails(creds)
+        except ResyncInProgress:
+            # Another process took it over first
+            continue
+        except Exception:
+            log.exception("resync resume failed", extra={"account": user_email})
+
+
+def _resume_loop():
+    # Every process runs this; the checkpoint claim lets only one resume each resync.
+    while not _stop.is_set():
+        try:
+            resume_interrupted_resyncs()
+        except Exception:
+            log.exception("resync resume error")
+        _stop.wait(RESUME_INTERVAL)
+
+
+def start_workers(count=SYNC_WORKERS):
+    _stop.clear()
+    t = threading.Thread(target=_resume_loop, name="resync-resume", daemon=True)
+    t.start()
+    _threads.append(t)
+    for i in range(count):
+        t = threading.Thread(target=_worker_loop, name=f"sync-worker-{i}", daemon=True)
+        t.start()
+        _threads.append(t)
+
+
+def stop_workers(timeout=10):
+    _stop.set()
+    for t in _threads:
+        t.join(timeout)
+    _threads.clear()
@@ -0,0 +1,4 @@
+import os, sys
+
+# The modules live at the repository root, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
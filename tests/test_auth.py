@@ -0,0 +1,37 @@
+import os
+from datetime import datetime, timedelta
+import pytest
+from fastapi import HTTPException
+from google.oauth2.credentials import Credentials
+import auth
+
+
+def _token(expiry):
+    return Credentials(token="access", refresh_token="refresh", token_uri="https://oauth2.example.com/token",
+                       client_id="id", client_secret="secret", expiry=expiry)
+
+
+def test_cached_credentials_skip_the_token_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(auth, "TOKEN_DIR", str(tmp_path))
+    monkeypatch.setattr(auth, "_creds", {})
+    creds = _token(datetime.utcnow() + timedelta(hours=1))
+    auth.save_credentials("me@example.com", creds)
+
+    def listdir(path):
+        raise AssertionError("TOKEN_DIR listed for a cached account")
+
+    monkeypatch.setattr(os, "listdir", listdir)
+    assert auth.get_credentials("me@example.com") is creds
+
+
+def test_unknown_and_invalid_accounts_are_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(auth, "TOKEN_DIR", str(tmp_path))
+    monkeypatch.setattr(auth, "_creds", {})
+    auth.save_credentials("me@example.com", _token(datetime.utcnow() + timedelta(hours=1)))
+
+    with pytest.raises(HTTPException) as invalid:
+        auth.get_credentials("../me@example.com")
+    assert invalid.value.status_code == 400
+    with pytest.raises(HTTPException) as unknown:
+        auth.get_credentials("other@example.com")
+    assert unknown.value.status_code == 404
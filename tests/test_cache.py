@@ -0,0 +1,48 @@
+import asyncio
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from cache import MemoryCache, set_cache, get_cache, generation, listing_key, email_key, invalidate_all
+from models import Base, EmailChange
+import main
+
+
+def test_invalidate_all_drops_entries_and_moves_generation():
+    set_cache(MemoryCache())
+    cache = get_cache()
+    key = listing_key("emails", [("limit", "20")])
+    cache.set(key, b"page")
+    cache.set(email_key(1), b"email")
+
+    invalidate_all()
+
+    assert cache.get(key) is None and cache.get(email_key(1)) is None
+    assert generation() == 1
+    assert listing_key("emails", [("limit", "20")]) != key
+
+
+def test_changes_committed_elsewhere_drop_the_memory_cache(tmp_path, monkeypatch):
+    path = tmp_path / "changes.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    monkeypatch.setattr(main, "AsyncSessionLocal", async_sessionmaker(async_engine))
+    monkeypatch.setattr(main, "CHANGES_POLL_INTERVAL", 0.01)
+    set_cache(MemoryCache())
+
+    async def scenario():
+        follower = asyncio.create_task(main._follow_changes())
+        await asyncio.sleep(0.05)
+        get_cache().set(email_key(1), b"stale")
+        # Another process's sync commits a change
+        with sessionmaker(bind=engine)() as db:
+            db.add(EmailChange(account_id=1, email_id=1, message_id="m1", op="update", changed_at=datetime.utcnow()))
+            db.commit()
+        await asyncio.sleep(0.1)
+        follower.cancel()
+        await async_engine.dispose()
+
+    asyncio.run(scenario())
+    assert get_cache().get(email_key(1)) is None
+    engine.dispose()
@@ -0,0 +1,101 @@
+from gmail_utils import compact_history, _in_mirror
+
+
+def _message(msg_id, labels=None, thread_id="t1"):
+    message = {"id": msg_id, "threadId": thread_id}
+    if labels is not None:
+        message["labelIds"] = labels
+    return message
+
+
+def _record(history_id, key, msg_id, labels, changed=None):
+    """One history.list record, shaped like Gmail's: the message carries its labels after the change."""
+    item = {"message": _message(msg_id, labels)}
+    if changed is not None:
+        item["labelIds"] = changed
+    return {"id": str(history_id), "messages": [_message(msg_id)], key: [item]}
+
+
+def test_added_starred_unstarred_trashed_needs_no_fetch_or_write():
+    records = [
+        _record(1001, "messagesAdded", "m1", ["INBOX", "UNREAD", "CATEGORY_PERSONAL"]),
+        _record(1002, "labelsAdded", "m1", ["INBOX", "UNREAD", "CATEGORY_PERSONAL", "STARRED"], ["STARRED"]),
+        _record(1003, "labelsRemoved", "m1", ["INBOX", "UNREAD", "CATEGORY_PERSONAL"], ["STARRED"]),
+        _record(1004, "labelsAdded", "m1", ["TRASH", "UNREAD", "CATEGORY_PERSONAL"], ["TRASH"]),
+        _record(1004, "labelsRemoved", "m1", ["TRASH", "UNREAD", "CATEGORY_PERSONAL"], ["INBOX"]),
+    ]
+
+    change = compact_history(records)["m1"]
+
+    assert change["new"] and not change["deleted"]
+    # The star came and went within the page
+    assert change["added"] == {"TRASH"}
+    assert change["removed"] == {"INBOX"}
+    assert change["labels"] == {"TRASH", "UNREAD", "CATEGORY_PERSONAL"}
+    # Ends outside the mirror: sync_history neither fetches it nor writes anything
+    assert not _in_mirror(change)
+
+
+def test_inbox_removed_and_added_back_cancels_out():
+    records = [
+        _record(2001, "labelsRemoved", "m2", ["UNREAD"], ["INBOX"]),
+        _record(2002, "labelsAdded", "m2", ["UNREAD", "INBOX"], ["INBOX"]),
+    ]
+
+    change = compact_history(records)["m2"]
+
+    assert change == {
+        "new": False, "deleted": False, "added": set(), "removed": set(), "labels": {"UNREAD", "INBOX"},
+    }
+    assert _in_mirror(change)
+
+
+def test_inbox_removed_and_added_back_without_label_sets_cancels_out():
+    records = [
+        _record(2101, "labelsRemoved", "m2", None, ["INBOX"]),
+        _record(2102, "labelsAdded", "m2", None, ["INBOX"]),
+    ]
+
+    change = compact_history(records)["m2"]
+
+    assert change["added"] == change["removed"] == set()
+    assert change["labels"] is None
+    assert _in_mirror(change)
+
+
+def test_deleted_overrides_earlier_label_changes():
+    records = [
+        _record(3001, "labelsAdded", "m3", ["INBOX", "STARRED"], ["STARRED"]),
+        _record(3002, "labelsRemoved", "m3", ["STARRED"], ["INBOX"]),
+        _record(3003, "labelsAdded", "m3", ["STARRED", "INBOX"], ["INBOX"]),
+        {"id": "3004", "messages": [_message("m3")], "messagesDeleted": [{"message": _message("m3")}]},
+    ]
+
+    change = compact_history(records)["m3"]
+
+    assert change["deleted"]
+    assert change["added"] == {"STARRED"}
+    assert not _in_mirror(change)
+
+
+def test_changes_are_kept_per_message():
+    records = [
+        {
+            "id": "4001",
+            "messages": [_message("a"), _message("b", thread_id="t2")],
+            "messagesAdded": [
+                {"message": _message("a", ["INBOX"])},
+                {"message": _message("b", ["INBOX", "SPAM"], thread_id="t2")},
+            ],
+        },
+        _record(4002, "labelsRemoved", "c", None, ["INBOX"]),
+    ]
+
+    changes = compact_history(records)
+
+    assert set(changes) == {"a", "b", "c"}
+    assert _in_mirror(changes["a"])
+    # Excluded labels keep a message out even with INBOX
+    assert not _in_mirror(changes["b"])
+    # Without a label set, the removal itself decides
+    assert not _in_mirror(changes["c"])
@@ -0,0 +1,52 @@
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from models import Base, OutboxMessage
+from outbox import _claim
+
+MESSAGES = 30
+
+
+def test_concurrent_claims_never_take_the_same_message(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'outbox.db'}", connect_args={"timeout": 30})
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as db:
+        due = datetime.utcnow() - timedelta(seconds=1)
+        db.add_all([
+            OutboxMessage(user_email="me@example.com", to_email="you@example.com", subject=f"m{i}",
+                          body="hello", attachments="[]", status="queued", next_attempt_at=due)
+            for i in range(MESSAGES)
+        ])
+        db.commit()
+
+    barrier = threading.Barrier(2)
+    claims = [[], []]
+    errors = []
+
+    def claimer(n):
+        try:
+            barrier.wait()
+            with Session() as db:
+                while True:
+                    ids = _claim(db, limit=5)
+                    if not ids:
+                        break
+                    claims[n].extend(ids)
+        except Exception as exc:
+            errors.append(exc)
+
+    workers = [threading.Thread(target=claimer, args=(n,)) for n in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert not errors
+
+    assert not set(claims[0]) & set(claims[1])
+    assert len(claims[0]) + len(claims[1]) == MESSAGES
+    with Session() as db:
+        assert {m.status for m in db.query(OutboxMessage)} == {"sending"}
+        assert {m.attempts for m in db.query(OutboxMessage)} == {1}
+    engine.dispose()
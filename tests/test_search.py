@@ -0,0 +1,50 @@
+from datetime import datetime
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from models import Base, Email
+from search import ensure_search_index
+import main
+
+
+def _client(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'search.db'}")
+    Base.metadata.create_all(bind=engine)
+    ensure_search_index(engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as db:
+        db.add_all([
+            Email(subject="Quarterly report", from_email="boss@example.com", body="numbers attached",
+                  message_id="m1", date=datetime(2024, 1, 1)),
+            Email(subject="Lunch", from_email="friend@example.com", body="pizza at noon",
+                  message_id="m2", date=datetime(2024, 1, 2)),
+        ])
+        db.commit()
+
+    def get_db():
+        with Session() as db:
+            yield db
+
+    main.app.dependency_overrides[main.get_db] = get_db
+    return TestClient(main.app), engine
+
+
+def test_search_finds_matching_email(tmp_path):
+    client, engine = _client(tmp_path)
+    try:
+        response = client.get("/emails/search", params={"q": "quarterly"})
+        assert response.status_code == 200
+        assert [hit["subject"] for hit in response.json()["items"]] == ["Quarterly report"]
+    finally:
+        main.app.dependency_overrides.clear()
+        engine.dispose()
+
+
+def test_search_rejects_blank_query(tmp_path):
+    client, engine = _client(tmp_path)
+    try:
+        response = client.get("/emails/search", params={"q": "   "})
+        assert response.status_code == 400
+    finally:
+        main.app.dependency_overrides.clear()
+        engine.dispose()
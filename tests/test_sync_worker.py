@@ -0,0 +1,33 @@
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from models import Base, SyncJob
+import sync_worker
+
+
+def test_running_sync_keeps_its_lease(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'jobs.db'}", connect_args={"timeout": 30})
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    monkeypatch.setattr(sync_worker, "SessionLocal", Session)
+    monkeypatch.setattr(sync_worker, "JOB_LEASE", timedelta(seconds=0.3))
+    monkeypatch.setattr(sync_worker, "LEASE_RENEW_INTERVAL", 0.05)
+
+    with Session() as db:
+        claimed = datetime.utcnow()
+        db.add_all([
+            SyncJob(id=1, user_email="live@example.com", history_id=10, status="running", locked_at=claimed),
+            SyncJob(id=2, user_email="dead@example.com", history_id=10, status="running", locked_at=claimed),
+        ])
+        db.commit()
+
+    # Job 1 is synced for longer than the lease; job 2's worker died
+    with sync_worker._held_lease([1]):
+        time.sleep(0.6)
+        sync_worker.recover_running_jobs()
+
+    with Session() as db:
+        assert db.get(SyncJob, 1).status == "running"
+        assert db.get(SyncJob, 2).status == "pending"
+    engine.dispose()
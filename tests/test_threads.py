@@ -0,0 +1,59 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from models import Base, Account, Thread
+from threads import add_to_threads
+
+PAGES = 20
+
+
+def _row(sync, page):
+    return {
+        "thread_id": "t1",
+        "subject": f"sync {sync} page {page}",
+        "body": "hello",
+        "from_email": f"sender{sync}@example.com",
+        "to_email": "me@example.com",
+        "date": datetime(2024, 1, 1) + timedelta(minutes=page * 2 + sync),
+        "is_starred": page % 2 == 0,
+    }
+
+
+def test_concurrent_syncs_fold_into_one_thread(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'threads.db'}", connect_args={"timeout": 30})
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as db:
+        db.add(Account(id=1, email="me@example.com", created_at=datetime.utcnow()))
+        db.commit()
+
+    barrier = threading.Barrier(2)
+    errors = []
+
+    def sync(n):
+        # Each page commits on its own, like ingestion does
+        try:
+            barrier.wait()
+            for page in range(PAGES):
+                with Session() as db:
+                    add_to_threads(db, 1, [_row(n, page)])
+                    db.commit()
+        except Exception as exc:
+            errors.append(exc)
+
+    workers = [threading.Thread(target=sync, args=(n,)) for n in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert not errors
+
+    with Session() as db:
+        thread = db.query(Thread).one()
+        assert thread.message_count == 2 * PAGES
+        assert thread.starred_count == PAGES
+        assert thread.subject == f"sync 1 page {PAGES - 1}"
+        assert {"sender0@example.com", "sender1@example.com"} <= set(json.loads(thread.participants_json))
+    engine.dispose()
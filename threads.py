@@ -0,0 +1,166 @@
+import json
+from collections import defaultdict
+from email.utils import getaddresses
+from sqlalchemy import inspect, insert, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from models import Email, Thread
+
+# Addresses kept per thread; huge mailing-list threads stop growing the row here.
+PARTICIPANTS_LIMIT = 50
+
+
+def ensure_thread_column(engine):
+    """Add emails.thread_id to databases created before threads existed (idempotent)."""
+    if "thread_id" in {c["name"] for c in inspect(engine).get_columns("emails")}:
+        return
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE emails ADD COLUMN thread_id VARCHAR"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_emails_account_thread_date ON emails (account_id, thread_id, date)"
+        ))
+
+
+def _addresses(*headers):
+    return [addr.lower() for _, addr in getaddresses([h for h in headers if h]) if addr]
+
+
+def _lock_threads(db, account_id, thread_ids):
+    """
+    Create the missing thread rows and lock them all until the caller
+    commits, then return {thread_id: Thread} with their latest values.
+    Concurrent syncs touching a thread thus fold into it one after another
+    instead of overwriting each other's aggregates.
+    """
+    thread_ids = sorted(thread_ids)
+    rows = [
+        {"account_id": account_id, "thread_id": t, "message_count": 0, "starred_count": 0, "participants": "[]"}
+        for t in thread_ids
+    ]
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        db.execute(postgresql.insert(Thread.__table__).values(rows).on_conflict_do_nothing(
+            index_elements=["account_id", "thread_id"]
+        ))
+    elif dialect == "sqlite":
+        # Also takes SQLite's write lock, which is what serializes the syncs there
+        db.execute(sqlite.insert(Thread.__table__).values(rows).on_conflict_do_nothing(
+            index_elements=["account_id", "thread_id"]
+        ))
+    else:
+        existing = {
+            row.thread_id for row in
+            db.query(Thread.thread_id).filter(Thread.account_id == account_id, Thread.thread_id.in_(thread_ids))
+        }
+        missing = [r for r in rows if r["thread_id"] not in existing]
+        if missing:
+            db.execute(insert(Thread.__table__).values(missing))
+
+    # Locked in thread_id order, so two syncs cannot deadlock on each other's threads
+    return {
+        t.thread_id: t
+        for t in db.query(Thread)
+        .filter(Thread.account_id == account_id, Thread.thread_id.in_(thread_ids))
+        .order_by(Thread.thread_id)
+        .with_for_update()
+        .populate_existing()
+    }
+
+
+def _apply(thread, messages):
+    """Fold messages (dicts of Email columns, oldest first) into the thread's aggregates."""
+    participants = thread.participants
+    seen = set(participants)
+    for msg in messages:
+        # The DateTime columns keep wall-clock time and drop the UTC offset
+        date = msg["date"].replace(tzinfo=None) if msg["date"] else None
+        thread.message_count = (thread.message_count or 0) + 1
+        thread.starred_count = (thread.starred_count or 0) + (1 if msg["is_starred"] else 0)
+        if thread.last_date is None or (date and date >= thread.last_date):
+            thread.last_date = date
+            thread.subject = msg["subject"]
+            thread.snippet = msg["body"]
+        for addr in _addresses(msg["from_email"], msg["to_email"]):
+            if addr not in seen and len(participants) < PARTICIPANTS_LIMIT:
+                seen.add(addr)
+                participants.append(addr)
+    thread.participants_json = json.dumps(participants)
+
+
+def add_to_threads(db, account_id, rows):
+    """
+    Count freshly inserted email rows (dicts of Email columns) into their
+    threads, creating threads as needed. Only reads the affected thread rows.
+    """
+    grouped = defaultdict(list)
+    for row in rows:
+        if row.get("thread_id"):
+            grouped[row["thread_id"]].append(row)
+    if not grouped:
+        return
+
+    threads = _lock_threads(db, account_id, grouped)
+    for thread_id, messages in grouped.items():
+        _apply(threads[thread_id], sorted(messages, key=lambda m: m["date"].replace(tzinfo=None)))
+    db.flush()
+
+
+def refresh_threads(db, account_id, thread_ids):
+    """
+    Recompute the given threads from their own emails, after deletes or
+    star changes; threads left without emails are removed. Reads only the
+    affected threads' emails, through ix_emails_account_thread_date.
+    """
+    thread_ids = {t for t in thread_ids if t}
+    if not thread_ids:
+        return
+
+    # Locked before counting, so emails committed meanwhile are either counted
+    # here or added by their own sync after this commit
+    threads = _lock_threads(db, account_id, thread_ids)
+    grouped = defaultdict(list)
+    emails = (
+        db.query(Email.thread_id, Email.subject, Email.body, Email.from_email, Email.to_email,
+                 Email.date, Email.is_starred)
+        .filter(Email.account_id == account_id, Email.thread_id.in_(list(thread_ids)))
+        .order_by(Email.date)
+    )
+    for email in emails:
+        grouped[email.thread_id].append(email._asdict())
+
+    for thread_id in thread_ids:
+        thread = threads[thread_id]
+        messages = grouped.get(thread_id)
+        if not messages:
+            db.delete(thread)
+            continue
+        thread.message_count = thread.starred_count = 0
+        thread.last_date = None
+        thread.participants_json = "[]"
+        _apply(thread, messages)
+    db.flush()
+
+
+def thread_ids_of(db, email_ids):
+    """Gmail threadIds of the given emails; call before deleting them."""
+    email_ids = list(set(email_ids))
+    if not email_ids:
+        return set()
+    return {row.thread_id for row in db.query(Email.thread_id).filter(Email.id.in_(email_ids))}
+
+
+def assign_threads(db, account_id, thread_ids):
+    """
+    Fill in thread_id for stored emails that predate it, from a
+    {message_id: threadId} map (messages.list returns threadId for free).
+    """
+    if not thread_ids:
+        return
+    missing = (
+        db.query(Email.id, Email.message_id)
+        .filter(Email.account_id == account_id, Email.message_id.in_(list(thread_ids)), Email.thread_id.is_(None))
+        .all()
+    )
+    if not missing:
+        return
+    db.execute(update(Email), [{"id": e.id, "thread_id": thread_ids[e.message_id]} for e in missing])
+    refresh_threads(db, account_id, {thread_ids[e.message_id] for e in missing})